@@ -0,0 +1,79 @@
+# async_db.py
+"""
+نسخة غير متزامنة (awaitable) من دوال database.py لاستخدامها داخل معالجات البوت.
+كل دالة تنفَّذ على خيوط (Threads) محدودة العدد حتى ما تجمّد الـ event loop الخاص بالبوت.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+from metrics import DB_FUNCTION_SECONDS
+
+# عدد الخيوط = أكبر عدد اتصالات بالـ Pool، حتى ما يبقى خيط ينتظر اتصال فارغ
+_executor = ThreadPoolExecutor(max_workers=database.DB_POOL_MAX, thread_name_prefix="db")
+
+async def run_db(func, *args, **kwargs):
+    """تنفذ دالة قاعدة بيانات متزامنة على خيوط الـ DB وترجع نتيجتها."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+def _awaitable(func):
+    """تحول دالة من database.py إلى دالة async بنفس الاسم والتوقيع."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with DB_FUNCTION_SECONDS.time(func.__name__):
+            return await run_db(func, *args, **kwargs)
+    return wrapper
+
+def shutdown():
+    """تنتظر انتهاء الاستعلامات الجارية ثم تغلق الخيوط واتصالات الـ Pool."""
+    _executor.shutdown(wait=True)
+    database.close_pool()
+
+# ------------------------------------------------------------------------------------------------
+# دوال المحلات (Shops)
+# ------------------------------------------------------------------------------------------------
+add_shop = _awaitable(database.add_shop)
+add_shops_bulk = _awaitable(database.add_shops_bulk)
+get_all_shops = _awaitable(database.get_all_shops)
+update_shop_details = _awaitable(database.update_shop_details)
+delete_shop = _awaitable(database.delete_shop)
+
+# ------------------------------------------------------------------------------------------------
+# دوال المجهزين (Agents)
+# ------------------------------------------------------------------------------------------------
+add_agent = _awaitable(database.add_agent)
+get_all_agents = _awaitable(database.get_all_agents)
+get_agent_name_by_id = _awaitable(database.get_agent_name_by_id)
+update_agent_details = _awaitable(database.update_agent_details)
+delete_agent = _awaitable(database.delete_agent)
+
+# ------------------------------------------------------------------------------------------------
+# دوال الربط (Assignment)
+# ------------------------------------------------------------------------------------------------
+get_assigned_shop_ids = _awaitable(database.get_assigned_shop_ids)
+toggle_agent_shop_assignment = _awaitable(database.toggle_agent_shop_assignment)
+toggle_agent_shop = _awaitable(database.toggle_agent_shop)
+assign_all_shops = _awaitable(database.assign_all_shops)
+unassign_all_shops = _awaitable(database.unassign_all_shops)
+assign_shops_by_search = _awaitable(database.assign_shops_by_search)
+copy_agent_assignments = _awaitable(database.copy_agent_assignments)
+
+# ------------------------------------------------------------------------------------------------
+# دوال تسجيل الدخول والبحث
+# ------------------------------------------------------------------------------------------------
+check_agent_code = _awaitable(database.check_agent_code)
+set_agent_telegram_id = _awaitable(database.set_agent_telegram_id)
+get_agent_by_telegram_id = _awaitable(database.get_agent_by_telegram_id)
+get_agent_telegram_ids = _awaitable(database.get_agent_telegram_ids)
+clear_agent_telegram_ids = _awaitable(database.clear_agent_telegram_ids)
+get_agent_shops_by_search = _awaitable(database.get_agent_shops_by_search)
+get_shops_by_search = _awaitable(database.get_shops_by_search)
+get_agent_shops_by_prefix = _awaitable(database.get_agent_shops_by_prefix)
+
+# ------------------------------------------------------------------------------------------------
+# دوال التقسيم لصفحات (Keyset Pagination)
+# ------------------------------------------------------------------------------------------------
+get_shops_page = _awaitable(database.get_shops_page)
+get_agent_shops_page = _awaitable(database.get_agent_shops_page)
@@ -0,0 +1,373 @@
+# benchmark.py
+"""
+قياس أداء معالجات البوت داخل نفس العملية (بدون شبكة تيليجرام).
+
+يبني نفس الـ Application اللي يشتغل بالإنتاج (build_application في main.py) لكن مع طبقة اتصال
+وهمية تسجل كل طلبات Bot API وترجع ردود جاهزة، ويمرر له تحديثات (Update) مصنّعة تمثل
+المدير (عرض وتصفح وبحث المحلات، تخصيص المحلات للمجهزين) والمجهزين (تسجيل الدخول والبحث).
+
+قاعدة البيانات: BENCH_DATABASE_URL (أو DATABASE_URL)، أو Postgres محلي مؤقت عبر مكتبة pgserver
+إذا كانت منصبة. كل الجداول تنبني داخل schema منفصل (shopsbot_bench) ينمسح بكل تشغيل،
+فما يتأثر أي جدول حقيقي.
+
+الاستخدام:
+    python benchmark.py --shops 500 --agents 50 --sessions 20 --concurrency 10
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import defaultdict
+from urllib.parse import quote
+
+try:
+    import pgserver
+except ImportError:
+    pgserver = None
+
+import psycopg2
+from telegram.request import BaseRequest
+
+BENCH_SCHEMA = "shopsbot_bench"
+BENCH_TOKEN = "123456:BENCHMARK"
+BENCH_BOT_ID = 123456
+
+
+# ------------------------------------------------------------------------------------------------
+# طبقة اتصال وهمية بتيليجرام
+# ------------------------------------------------------------------------------------------------
+
+class FakeTelegramRequest(BaseRequest):
+    """تستقبل طلبات Bot API، تسجلها، وترجع ردود مقبولة بدون أي اتصال بالشبكة."""
+
+    def __init__(self):
+        self.calls = defaultdict(int) # اسم الطلب -> العدد
+        self.last_markup = {} # chat_id -> آخر reply_markup انرسل أو انعدل
+        self._message_id = 1000
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def _message(self, chat_id, text):
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": BENCH_BOT_ID, "is_bot": True, "first_name": "Bench"},
+            "text": text or "",
+        }
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        params = request_data.parameters if request_data is not None else {}
+
+        if endpoint == "getMe":
+            result = {
+                "id": BENCH_BOT_ID, "is_bot": True, "first_name": "Bench",
+                "username": "bench_bot", "can_join_groups": False,
+                "can_read_all_group_messages": False, "supports_inline_queries": True,
+            }
+        elif endpoint in ("sendMessage", "editMessageText"):
+            chat_id = params.get("chat_id")
+            markup = params.get("reply_markup")
+            if markup is not None:
+                self.last_markup[chat_id] = json.loads(markup) if isinstance(markup, str) else markup
+            result = self._message(chat_id, params.get("text"))
+        else:
+            # answerCallbackQuery و answerInlineQuery و غيرها
+            result = True
+
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def buttons(self, chat_id, prefix: str) -> list:
+        """ترجع callback_data لأزرار آخر لوحة انرسلت للمحادثة واللي تبدأ بـ prefix."""
+        markup = self.last_markup.get(chat_id) or {}
+        return [
+            button["callback_data"]
+            for row in markup.get("inline_keyboard", [])
+            for button in row
+            if button.get("callback_data", "").startswith(prefix)
+        ]
+
+
+# ------------------------------------------------------------------------------------------------
+# تصنيع التحديثات
+# ------------------------------------------------------------------------------------------------
+
+class UpdateFactory:
+    """تصنع كائنات Update بنفس شكل اللي يوصل من الـ Webhook."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_id = 0
+
+    def _next_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    @staticmethod
+    def _user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def _raw_message(self, user_id, text):
+        message = {
+            "message_id": self._next_id(),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if text.startswith('/'):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return message
+
+    def message(self, user_id, text):
+        from telegram import Update
+        return Update.de_json({"update_id": self._next_id(), "message": self._raw_message(user_id, text)}, self.bot)
+
+    def callback(self, user_id, data):
+        from telegram import Update
+        raw = {
+            "update_id": self._next_id(),
+            "callback_query": {
+                "id": str(self._next_id()),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": self._raw_message(user_id, "bench"),
+            },
+        }
+        return Update.de_json(raw, self.bot)
+
+
+# ------------------------------------------------------------------------------------------------
+# تجهيز قاعدة البيانات
+# ------------------------------------------------------------------------------------------------
+
+def resolve_database_url():
+    """ترجع رابط قاعدة البيانات الأساسي (متغير بيئة أو Postgres مؤقت عبر pgserver)."""
+    url = os.getenv('BENCH_DATABASE_URL') or os.getenv('DATABASE_URL')
+    if url:
+        return url
+    if pgserver is None:
+        sys.exit("BENCH_DATABASE_URL is not set and pgserver is not installed (pip install pgserver).")
+    server = pgserver.get_server(os.path.join(os.getcwd(), '.bench_pgdata'), cleanup_mode='stop')
+    return server.get_uri()
+
+def prepare_schema(base_url: str) -> str:
+    """تنشئ schema نظيف للقياس وترجع رابط يخلي كل الاستعلامات تشتغل داخله."""
+    conn = psycopg2.connect(base_url)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        cursor.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+    conn.close()
+    separator = '&' if '?' in base_url else '?'
+    return f"{base_url}{separator}options={quote(f'-csearch_path={BENCH_SCHEMA},public')}"
+
+def seed(database, shops: int, agents: int, shops_per_agent: int):
+    """تملأ القاعدة بمحلات ومجهزين وربط عشوائي ثابت (seed ثابت حتى تتكرر النتائج)."""
+    rng = random.Random(42)
+    database.add_shops_bulk([(f"محل {i:05d}", f"https://example.com/shop/{i}") for i in range(shops)])
+    shop_ids = [shop['id'] for shop in database.get_all_shops()]
+    agent_ids = []
+    for j in range(agents):
+        database.add_agent(f"مجهز {j:04d}", f"code{j:04d}")
+    for agent in database.get_all_agents():
+        agent_ids.append(agent['id'])
+        for shop_id in rng.sample(shop_ids, min(shops_per_agent, len(shop_ids))):
+            database.toggle_agent_shop_assignment(agent['id'], shop_id, True)
+    return shop_ids, agent_ids
+
+
+# ------------------------------------------------------------------------------------------------
+# السيناريوهات
+# ------------------------------------------------------------------------------------------------
+
+def admin_session(factory, request, user_id, agent_ids, toggles: int, rng):
+    """خطوات جلسة مدير: (اسم الخطوة، دالة تصنع التحديث). التحديث يتصنع وقت التنفيذ حتى يستخدم آخر لوحة."""
+    def callback(data_fn):
+        return lambda: factory.callback(user_id, data_fn() if callable(data_fn) else data_fn)
+
+    def first_button(prefix, fallback):
+        return lambda: (request.buttons(user_id, prefix) or [fallback])[0]
+
+    steps = [
+        ("start", lambda: factory.message(user_id, "/start")),
+        ("admin_list", callback("show_shops_list")),
+        ("admin_page", callback(first_button("shops_pg_n_", "show_shops_list"))),
+        ("admin_search", lambda: factory.message(user_id, f"محل {rng.randrange(100):02d}")),
+        ("admin_menu", callback("admin_menu")),
+        ("agents_list", callback("manage_agents")),
+        ("assign_open", callback(f"assign_shops_{rng.choice(agent_ids)}")),
+    ]
+    for i in range(toggles):
+        steps.append(("assign_toggle", callback(
+            lambda i=i: (request.buttons(user_id, "toggle_shop_") or ["toggle_shop_0"])[i % 5]
+        )))
+    return steps
+
+def agent_session(factory, user_id, code, rng):
+    """خطوات جلسة مجهز: تسجيل دخول، عرض المحلات، بحث."""
+    return [
+        ("start", lambda: factory.message(user_id, "/start")),
+        ("agent_login_prompt", lambda: factory.callback(user_id, "agent_login_prompt")),
+        ("agent_login", lambda: factory.message(user_id, code)),
+        ("agent_list", lambda: factory.callback(user_id, "show_agent_shops")),
+        ("agent_search", lambda: factory.message(user_id, f"محل {rng.randrange(100):02d}")),
+    ]
+
+
+# ------------------------------------------------------------------------------------------------
+# التشغيل والقياس
+# ------------------------------------------------------------------------------------------------
+
+class Recorder:
+    """يجمع زمن كل خطوة وعدد الاستعلامات وطلبات تيليجرام لكل نوع معالج."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.api_calls = defaultdict(list)
+
+    def report(self, title: str, wall_time: float = None):
+        lines = [f"\n== {title} =="]
+        header = f"{'handler':<20}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'q/upd':>8}{'api/upd':>9}"
+        lines.append(header)
+        lines.append('-' * len(header))
+        total = 0
+        for label in sorted(self.latencies):
+            values = sorted(self.latencies[label])
+            total += len(values)
+            queries = self.queries.get(label)
+            api_calls = self.api_calls.get(label)
+            lines.append(
+                f"{label:<20}{len(values):>6}"
+                f"{percentile(values, 50) * 1000:>10.2f}{percentile(values, 95) * 1000:>10.2f}"
+                f"{percentile(values, 99) * 1000:>10.2f}"
+                f"{(sum(queries) / len(queries)) if queries else float('nan'):>8.2f}"
+                f"{(sum(api_calls) / len(api_calls)) if api_calls else float('nan'):>9.2f}"
+            )
+        if wall_time:
+            lines.append(f"throughput: {total / wall_time:.1f} updates/s ({total} updates in {wall_time:.2f}s)")
+        print("\n".join(lines))
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+async def run_sequential(application, request, sessions, recorder, query_counter):
+    """كل خطوة لوحدها حتى نعرف بالضبط كم استعلام وكم طلب API تحتاج."""
+    import message_edits
+    for steps in sessions:
+        for label, make_update in steps:
+            update = make_update()
+            queries_before, api_before = query_counter[0], request.total_calls()
+            started = time.perf_counter()
+            await application.process_update(update)
+            # إعادة العرض المجدولة (مثل ضغطات الربط) جزء من كلفة الخطوة
+            await message_edits.wait_for_renders()
+            recorder.latencies[label].append(time.perf_counter() - started)
+            recorder.queries[label].append(query_counter[0] - queries_before)
+            recorder.api_calls[label].append(request.total_calls() - api_before)
+
+async def run_concurrent(application, sessions, recorder, concurrency: int):
+    """نفس الجلسات لكن بالتوازي عبر الـ Update Processor الحقيقي (مثل الإنتاج)."""
+    import message_edits
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_session(steps):
+        async with semaphore:
+            for label, make_update in steps:
+                update = make_update()
+                started = time.perf_counter()
+                await application.update_processor.process_update(update, application.process_update(update))
+                recorder.latencies[label].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_session(steps) for steps in sessions))
+    await message_edits.wait_for_renders()
+    return time.perf_counter() - started
+
+async def run(args):
+    os.environ['DATABASE_URL'] = prepare_schema(resolve_database_url())
+    # نقيس كلفة المعالجات نفسها، فنطفي حدود الإرسال لتيليجرام (ما اكو تيليجرام حقيقي هنا)
+    os.environ.setdefault('TELEGRAM_RATE_LIMIT', '0')
+    # بدون تأجيل إعادة العرض، حتى تنحسب على الخطوة نفسها بدون انتظار EDIT_DEBOUNCE_MS
+    os.environ.setdefault('EDIT_DEBOUNCE_MS', '0')
+    os.environ.setdefault('SECRET_CODE_PEPPER', 'benchmark')
+
+    # الاستيراد بعد ضبط DATABASE_URL لأن database.py يقرأه عند التحميل
+    import database
+    import main
+
+    database.setup_db()
+    started = time.perf_counter()
+    shop_ids, agent_ids = seed(database, args.shops, args.agents, args.shops_per_agent)
+    print(f"seeded {len(shop_ids)} shops, {len(agent_ids)} agents in {time.perf_counter() - started:.2f}s")
+
+    # عداد رحلات قاعدة البيانات (كل استعارة اتصال = رحلة وحدة)
+    query_counter = [0]
+    original_get_connection = database.get_connection
+
+    def counting_get_connection(*args, **kwargs):
+        query_counter[0] += 1
+        return original_get_connection(*args, **kwargs)
+    database.get_connection = counting_get_connection
+
+    request = FakeTelegramRequest()
+    application = main.build_application(BENCH_TOKEN, request=request)
+    factory = UpdateFactory(application.bot)
+    rng = random.Random(7)
+
+    def build_sessions(round_no):
+        sessions = []
+        for i in range(args.sessions):
+            admin_id = 9_000_000 + round_no * 10_000 + i
+            main.ADMIN_IDS.append(admin_id)
+            sessions.append(admin_session(factory, request, admin_id, agent_ids, args.toggles, rng))
+            agent_no = rng.randrange(len(agent_ids))
+            sessions.append(agent_session(factory, 8_000_000 + round_no * 10_000 + i, f"code{agent_no:04d}", rng))
+        return sessions
+
+    async with application:
+        sequential = Recorder()
+        await run_sequential(application, request, build_sessions(0), sequential, query_counter)
+        sequential.report("sequential (per-update cost)")
+
+        concurrent = Recorder()
+        wall_time = await run_concurrent(application, build_sessions(1), concurrent, args.concurrency)
+        concurrent.report(f"concurrent (concurrency={args.concurrency})", wall_time)
+
+        print(f"\ntelegram api calls: {dict(request.calls)}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="قياس أداء معالجات البوت محلياً.")
+    parser.add_argument('--shops', type=int, default=500, help="عدد المحلات")
+    parser.add_argument('--agents', type=int, default=50, help="عدد المجهزين")
+    parser.add_argument('--shops-per-agent', type=int, default=40, help="عدد المحلات المربوطة بكل مجهز")
+    parser.add_argument('--sessions', type=int, default=20, help="عدد جلسات المدير (ونفسها للمجهزين) بكل مرحلة")
+    parser.add_argument('--toggles', type=int, default=10, help="عدد ضغطات الربط بكل جلسة مدير")
+    parser.add_argument('--concurrency', type=int, default=10, help="عدد الجلسات المتوازية")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -1,9 +1,24 @@
 # database.py
 import os
+import time
+import uuid
+import socket
 import logging
+import threading
+import functools
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
 import psycopg2
 from psycopg2 import sql
 import psycopg2.extras # 👈🏼 تم إضافة الاستدعاء هذا لكي يعمل RealDictCursor
+import psycopg2.pool
+import psycopg2.errors
+
+from metrics import DB_QUERY_SECONDS, DB_QUERY_ERRORS, DB_POOL_ACQUIRE_SECONDS, DB_READ_QUERIES
+import query_profiler
+from migrations import apply_migrations
+from secret_codes import hash_secret_code
 
 # تفعيل نظام الـ Logging
 logging.basicConfig(
@@ -13,189 +28,640 @@ logger = logging.getLogger(__name__)
 
 # الحصول على URL الاتصال بقاعدة البيانات من متغيرات البيئة (PostgreSQL)
 DATABASE_URL = os.getenv('DATABASE_URL')
+# نسخ للقراءة فقط (Read Replicas) مفصولة بفواصل: استعلامات القراءة تتوزع عليها بالتناوب
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+# بعد أي تعديل، القراءات تروح للقاعدة الأساسية لهالمدة (حتى ما نقرأ من نسخة متأخرة عن التعديل)
+DB_READ_YOUR_WRITES_SECONDS = float(os.getenv('DB_READ_YOUR_WRITES_SECONDS', '5'))
+# النسخة اللي تفشل ما نرجع نستخدمها قبل هالمدة
+DB_REPLICA_RETRY_SECONDS = float(os.getenv('DB_REPLICA_RETRY_SECONDS', '30'))
+# أقصى مدة لفتح اتصال بنسخة قراءة (بالثواني)، حتى النسخة الواقفة ما تعلق الاتصالات طويلاً
+DB_REPLICA_CONNECT_TIMEOUT = int(os.getenv('DB_REPLICA_CONNECT_TIMEOUT', '3'))
+
+# إعدادات الـ Pool: أقل وأكثر عدد اتصالات مفتوحة، ومدة انتظار اتصال فارغ (بالثواني)
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+# الاتصال اللي بقى خامل أكثر من هالمدة نفحصه بـ SELECT 1 قبل ما نسلمه
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv('DB_POOL_HEALTHCHECK_IDLE', '30'))
+
+# عدد المحلات بكل صفحة من قوائم الأزرار
+SHOPS_PAGE_SIZE = int(os.getenv('SHOPS_PAGE_SIZE', '10'))
+
+# إعدادات البحث: 'trigram' (بحث تقريبي مرتب بـ pg_trgm) أو 'ilike' (البحث الجزئي القديم)
+SHOP_SEARCH_MODE = os.getenv('SHOP_SEARCH_MODE', 'trigram')
+# أقل درجة تشابه (0 - 1) حتى يظهر المحل بنتائج البحث التقريبي
+SEARCH_SIMILARITY_THRESHOLD = float(os.getenv('SEARCH_SIMILARITY_THRESHOLD', '0.3'))
+# أكثر عدد نتائج يرجعها البحث
+SEARCH_RESULT_LIMIT = int(os.getenv('SEARCH_RESULT_LIMIT', '10'))
+# أكثر عدد نتائج ببحث الـ Inline (تيليجرام يقبل 50 كحد أقصى)
+INLINE_RESULT_LIMIT = int(os.getenv('INLINE_RESULT_LIMIT', '20'))
+
+# يصير True بعد ما setup_db ينشئ امتداد pg_trgm والفهرس بنجاح
+_trigram_available = False
+
+# الكاش الداخلي لقوائم المحلات والمجهزين: مدة صلاحية السجل (بالثواني) وأكثر عدد سجلات
+CACHE_TTL = float(os.getenv('CACHE_TTL', '300'))
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '1024'))
+
+_catalog_version = 0 # يزيد مع كل تعديل على المحلات أو المجهزين
+_cache = OrderedDict() # key -> (version, expires_at, value)
+_cache_lock = threading.Lock()
+_query_state = threading.local() # يسجل إذا فشل استعلام بنفس الخيط (حتى ما نخزن نتيجة فاشلة)
+_query_failures = 0 # عدد الاستعلامات الفاشلة بكل الخيوط (render_cache يقارنه قبل وبعد الرسم)
+
+# وضع النسخ المتعددة (MULTI_REPLICA=1): عدة نسخ من البوت على نفس القاعدة، التفاصيل في replicas.py
+MULTI_REPLICA = os.getenv('MULTI_REPLICA', '0') == '1'
+# معرف هذه النسخة (للإيجار والإشعارات)، ويتغير مع كل تشغيل
+REPLICA_ID = os.getenv('REPLICA_ID') or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+# قناة LISTEN/NOTIFY اللي تبلغ بيها النسخ بعضها بتعديل المحلات أو المجهزين
+CHANGES_CHANNEL = 'shopsbot_changes'
+# نوع التعديل بالإشعار: الكتالوج (المحلات والمجهزين) يفرغ الكاش، والجلسات تفرغ فهرس الجلسات بس
+CHANGE_CATALOG = 'catalog'
+CHANGE_SESSIONS = 'sessions'
+
+_pools = {} # url -> Pool (الأساسية والنسخ)
+_pool_lock = threading.Lock()
+_last_used = {} # id(conn) -> آخر وقت رجع بيه الاتصال للـ Pool
+
+_last_write = float('-inf') # آخر تعديل (بهالنسخة من البوت أو بلغتنا بيه نسخة ثانية)
+_replica_turn = itertools.count()
+_replica_down_until = {} # url -> وقت نرجع نجرب النسخة بعد فشلها
+
+def get_pool(url: str = None):
+    """ترجع الـ Pool المشترك للقاعدة الأساسية (أو لنسخة القراءة url) وتنشئه أول مرة (Thread-safe)."""
+    url = url or DATABASE_URL
+    pool = _pools.get(url)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(url)
+            if pool is None:
+                if not url:
+                    raise Exception("DATABASE_URL environment variable is not set. Please add a PostgreSQL service in Railway.")
+                # نسخ القراءة بمهلة اتصال قصيرة، والأساسية بدون مهلة مثل قبل
+                connect_kwargs = {'connect_timeout': DB_REPLICA_CONNECT_TIMEOUT} if url != DATABASE_URL else {}
+                pool = psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, url, **connect_kwargs)
+                # psycopg2 يغلق أي اتصال راجع إذا صار عدد الخاملين >= minconn،
+                # فنرفع الحد بعد الإنشاء حتى تبقى الاتصالات مفتوحة لحد DB_POOL_MAX
+                pool.minconn = DB_POOL_MAX
+                # لكل Pool حده من الأماكن، حتى نسخة قراءة عالقة ما تاخذ أماكن الأساسية
+                pool.slots = threading.BoundedSemaphore(DB_POOL_MAX)
+                _pools[url] = pool
+    return pool
+
+def close_pool():
+    """تغلق كل اتصالات الـ Pools (عند إيقاف البوت)."""
+    with _pool_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+        _last_used.clear()
+
+def _is_healthy(conn) -> bool:
+    """تفحص الاتصال قبل تسليمه: المغلق مرفوض، والخامل لفترة طويلة يُفحص بـ SELECT 1."""
+    if conn.closed:
+        return False
+    idle_since = _last_used.get(id(conn))
+    if idle_since is not None and time.monotonic() - idle_since < DB_POOL_HEALTHCHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
-def connect_db():
-    """يربط بقاعدة بيانات PostgreSQL."""
-    if not DATABASE_URL:
-        # إذا لم يتم تعريف الـ URL، ارفع خطأ لأن البوت ما راح يشتغل
-        raise Exception("DATABASE_URL environment variable is not set. Please add a PostgreSQL service in Railway.")
-    conn = psycopg2.connect(DATABASE_URL)
-    return conn
+def _checkout(pool):
+    """تسحب اتصالاً سليماً من الـ Pool، وتستبدل الاتصالات الميتة (مثلاً بعد إعادة تشغيل Postgres)."""
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if _is_healthy(conn):
+            return conn
+        _last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError("Could not obtain a healthy database connection from the pool.")
+
+@contextmanager
+def get_connection(url: str = None):
+    """
+    تستعير اتصالاً من الـ Pool (الأساسية، أو نسخة القراءة url) وترجعه بعد الانتهاء.
+    إذا امتلأ الـ Pool تنتظر لحد DB_POOL_TIMEOUT، والاتصال اللي ينكسر أثناء الاستخدام يُغلق ولا يرجع.
+    """
+    acquire_started = time.perf_counter()
+    pool = get_pool(url)
+    slots = pool.slots
+    if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+        DB_POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - acquire_started)
+        raise psycopg2.pool.PoolError("Timed out waiting for a free database connection.")
+    conn = None
+    try:
+        conn = _checkout(pool)
+        DB_POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - acquire_started)
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        # الاتصال مكسور: نغلقه حتى ما يرجع للـ Pool
+        if conn is not None:
+            _last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+            conn = None
+        raise
+    finally:
+        if conn is not None:
+            _last_used[id(conn)] = time.monotonic()
+            pool.putconn(conn, close=bool(conn.closed))
+        slots.release()
 
 # ------------------------------------------------------------------------------------------------
 # الدالة الأساسية لتنفيذ الاستعلامات (execute_query)
 # ------------------------------------------------------------------------------------------------
-def execute_query(query: str, params: tuple = None, fetch_one: bool = False, fetch_all: bool = False):
+def execute_query(query: str, params: tuple = None, fetch_one: bool = False, fetch_all: bool = False,
+                  read_only: bool = False):
     """
-    تنفذ استعلام SQL، وتفتح وتغلق الاتصال بالقاعدة.
+    تنفذ استعلام SQL على اتصال مستعار من الـ Pool وترجعه بعد الانتهاء.
     ترجع قائمة من القواميس (عند fetch_all) أو قاموس واحد (عند fetch_one) أو True/False.
+    read_only=True: استعلام قراءة ممكن يروح لنسخة قراءة (DATABASE_REPLICA_URLS)، وإذا فشلت يرجع للأساسية.
     """
-    conn = None
+    replica = _pick_replica() if read_only else None
+    if replica is not None:
+        try:
+            result = _run_query(query, params, fetch_one, fetch_all, replica)
+            DB_READ_QUERIES.inc("replica")
+            return result
+        except psycopg2.pool.PoolError as e:
+            # كل اتصالات النسخة مشغولة: النسخة شغالة، والرجوع للأساسية يعني انتظار DB_POOL_TIMEOUT ثاني
+            logger.error(f"DB Error executing query: {e}")
+            _mark_query_failed()
+            return False
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            # النسخة واقفة أو ما تستقبل اتصالات: نتركها فترة ونقرأ من الأساسية
+            logger.warning(f"Read replica unavailable, falling back to primary: {e}")
+            _replica_down_until[replica] = time.monotonic() + DB_REPLICA_RETRY_SECONDS
+        except Exception as e:
+            logger.error(f"DB Error executing query: {e}")
+            _mark_query_failed()
+            return False
     try:
-        conn = connect_db()
-        # RealDictCursor يحول النتائج إلى قواميس (مفيدة جداً)
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) 
-        cursor.execute(query, params)
-        conn.commit()
-        
-        if fetch_one:
-            return cursor.fetchone()
-        elif fetch_all:
-            return cursor.fetchall()
-        else:
-            return True # تم التنفيذ بنجاح
-            
+        result = _run_query(query, params, fetch_one, fetch_all)
+        if read_only:
+            DB_READ_QUERIES.inc("primary")
+        return result
     except Exception as e:
-        # logger.error(f"DB Error executing query: {e}")
+        logger.error(f"DB Error executing query: {e}")
+        _mark_query_failed()
         return False
-        
-    finally:
-        if conn:
-            conn.close()
 
-def setup_db():
-    """إنشاء الجداول عند تشغيل البوت لأول مرة."""
-    conn = None
+class _ConnectionLost(psycopg2.OperationalError):
+    """الاتصال انقطع قبل الـ commit، فالأمر ما تنفذ وممكن نعيده على اتصال جديد."""
+
+def _run_query(query: str, params: tuple, fetch_one: bool, fetch_all: bool, url: str = None):
+    # الاتصالات المستخدمة قريباً ما تنفحص قبل التسليم، فبعد إعادة تشغيل Postgres أول أمر عليها يفشل:
+    # get_connection يرمي الاتصال الميت ونعيد الأمر مرة وحدة على اتصال جديد
     try:
-        conn = connect_db()
-        cursor = conn.cursor()
-        
-        # جدول المحلات (Shops)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS Shops (
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL UNIQUE,
-                url TEXT NOT NULL
-            )
-        """)
+        return _run_query_once(query, params, fetch_one, fetch_all, url)
+    except _ConnectionLost as e:
+        logger.warning(f"Database connection lost, retrying on a fresh connection: {e}")
+        return _run_query_once(query, params, fetch_one, fetch_all, url)
+
+def _run_query_once(query: str, params: tuple, fetch_one: bool, fetch_all: bool, url: str = None):
+    with get_connection(url) as conn:
+        started = time.perf_counter()
+        committing = False
+        try:
+            # RealDictCursor يحول النتائج إلى قواميس (مفيدة جداً)
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                cursor.execute(query, params)
+                if fetch_one:
+                    result = cursor.fetchone()
+                elif fetch_all:
+                    result = cursor.fetchall()
+                else:
+                    result = True # تم التنفيذ بنجاح
+                rowcount = cursor.rowcount
+            committing = True
+            conn.commit()
+        except (psycopg2.DatabaseError, psycopg2.InterfaceError) as e:
+            DB_QUERY_ERRORS.inc()
+            if not conn.closed:
+                conn.rollback()
+            elif not committing and isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                raise _ConnectionLost(str(e)) from e
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_QUERY_SECONDS.observe(elapsed)
+
+        if query_profiler.PROFILE_ENABLED and query_profiler.record(query, params, elapsed, rowcount):
+            _explain_query(conn, query, params)
+        return result
+
+def _pick_replica():
+    """نسخة القراءة التالية بالتناوب، أو None (نقرأ من الأساسية) إذا ما اكو نسخ سليمة أو صار تعديل قريب."""
+    if not DATABASE_REPLICA_URLS or time.monotonic() - _last_write < DB_READ_YOUR_WRITES_SECONDS:
+        return None
+    now = time.monotonic()
+    for _ in range(len(DATABASE_REPLICA_URLS)):
+        url = DATABASE_REPLICA_URLS[next(_replica_turn) % len(DATABASE_REPLICA_URLS)]
+        if _replica_down_until.get(url, 0) <= now:
+            return url
+    return None
+
+def note_write():
+    """
+    تسجل إن صار تعديل، فالقراءات تروح للقاعدة الأساسية لمدة DB_READ_YOUR_WRITES_SECONDS.
+    النافذة لكل البوت مو لكل مستخدم، لأن الكاش الداخلي مشترك: نتيجة قديمة من نسخة متأخرة تنخزن للكل.
+    """
+    global _last_write
+    _last_write = time.monotonic()
+
+def marks_write(func):
+    """تسجل تعديل (note_write) بعد تنفيذ دالة تعدل بيانات تنقرأ من نسخ القراءة (حتى لو فشلت)."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            note_write()
+    return wrapper
+
+class _InstrumentedCursor:
+    """
+    يضاف لصنف الـ cursor داخل transaction() حتى ينقاس كل أمر مثل execute_query
+    (DB_QUERY_SECONDS و query_profiler). الأوامر البطيئة تنحفظ بـ slow_statements ونشرحها بعد الـ commit.
+    """
+    _batching = False
+
+    def execute(self, query, vars=None):
+        if self._batching:
+            return super().execute(query, vars)
+        with self._timed(query, vars, explainable=True):
+            return super().execute(query, vars)
+
+    def execute_values(self, query, argslist, **kwargs):
+        """مثل psycopg2.extras.execute_values، بس تنقاس كأمر واحد باسم القالب (بدون القيم)."""
+        with self._timed(query, None, explainable=False):
+            self._batching = True
+            try:
+                return psycopg2.extras.execute_values(self, query, argslist, **kwargs)
+            finally:
+                self._batching = False
+
+    @contextmanager
+    def _timed(self, query, params, explainable: bool):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_QUERY_SECONDS.observe(elapsed)
+        if query_profiler.PROFILE_ENABLED and query_profiler.record(query, params, elapsed, self.rowcount):
+            if explainable:
+                self.slow_statements.append((query, params))
+
+class _TimedCursor(_InstrumentedCursor, psycopg2.extensions.cursor):
+    pass
+
+class _TimedRealDictCursor(_InstrumentedCursor, psycopg2.extras.RealDictCursor):
+    pass
+
+_TIMED_CURSORS = {None: _TimedCursor, psycopg2.extras.RealDictCursor: _TimedRealDictCursor}
+
+@contextmanager
+def transaction(cursor_factory=None):
+    """
+    وحدة عمل (Unit of Work): تعطي cursor على اتصال واحد لكل الأوامر اللي بداخلها،
+    وتعمل commit مرة وحدة بالنهاية، أو rollback إذا صار أي خطأ (والخطأ يرجع للمستدعي).
+    كل أمر ينقاس مثل execute_query، وللإدخال المتعدد استخدم cursor.execute_values(...).
+    مثال:
+        with transaction() as cursor:
+            cursor.execute(...)
+            cursor.execute(...)
+    """
+    with get_connection() as conn:
+        try:
+            with conn.cursor(cursor_factory=_TIMED_CURSORS[cursor_factory]) as cursor:
+                cursor.slow_statements = []
+                yield cursor
+            conn.commit()
+        except BaseException as e:
+            if isinstance(e, psycopg2.DatabaseError):
+                DB_QUERY_ERRORS.inc()
+            if not conn.closed:
+                conn.rollback()
+            raise
+        for query, params in cursor.slow_statements:
+            _explain_query(conn, query, params)
+
+def _explain_query(conn, query: str, params: tuple):
+    """
+    تسجل خطة تنفيذ استعلام بطيء بـ EXPLAIN (ANALYZE, BUFFERS).
+    ANALYZE ينفذ الاستعلام فعلياً، فنشغله داخل transaction ونلغيه (rollback) حتى ما يتكرر أي تعديل.
+    """
+    if ';' in query.strip().rstrip(';'):
+        return # EXPLAIN ما يقبل أكثر من أمر واحد
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        query_profiler.record_plan(query, plan)
+    except psycopg2.Error as e:
+        logger.warning(f"Could not explain slow query: {e}")
+    finally:
+        if not conn.closed:
+            conn.rollback()
+
+# ------------------------------------------------------------------------------------------------
+# الكاش الداخلي (Read-through Cache) لقوائم المحلات والمجهزين
+# ------------------------------------------------------------------------------------------------
+
+def _mark_query_failed() -> None:
+    global _query_failures
+    _query_state.failed = True
+    with _cache_lock:
+        _query_failures += 1
+
+def get_query_failure_count() -> int:
+    """ترجع عدد الاستعلامات اللي فشلت من بداية التشغيل."""
+    return _query_failures
+
+def get_catalog_version() -> int:
+    """ترجع رقم النسخة الحالية لبيانات المحلات والمجهزين."""
+    return _catalog_version
+
+def invalidate_catalog():
+    """تزيد رقم النسخة وتفرغ الكاش. تُستدعى بعد أي تعديل على المحلات أو المجهزين."""
+    global _catalog_version
+    note_write()
+    with _cache_lock:
+        _catalog_version += 1
+        _cache.clear()
+    _publish_change(CHANGE_CATALOG)
+
+def _publish_change(kind: str):
+    """بوضع النسخ المتعددة تبلغ النسخ الثانية بالتعديل (kind: CHANGE_CATALOG أو CHANGE_SESSIONS)."""
+    if MULTI_REPLICA:
+        execute_query("SELECT pg_notify(%s, %s)", (CHANGES_CHANNEL, f"{kind}:{REPLICA_ID}"))
+
+def parse_change(payload: str):
+    """تفكك إشعار التعديل إلى (kind, replica_id)."""
+    kind, _, replica_id = payload.partition(':')
+    return kind, replica_id
+
+def apply_remote_change(kinds=(CHANGE_CATALOG, CHANGE_SESSIONS)):
+    """
+    تُستدعى لما نسخة ثانية تعدل البيانات: تعديل الكتالوج يفرغ الكاش (وكاش الرسم معه)،
+    وتعديل الجلسات يفرغ فهرس الجلسات بس (ينعاد تحميله عند أول استخدام).
+    """
+    global _catalog_version, _agent_sessions
+    if CHANGE_CATALOG in kinds:
+        note_write()
+        with _cache_lock:
+            _catalog_version += 1
+            _cache.clear()
+    with _agent_sessions_lock:
+        _agent_sessions = None
+
+def cached_read(func):
+    """
+    يخزن نتيجة دالة القراءة بالذاكرة حسب (اسم الدالة، المعاملات) ونسخة البيانات الحالية.
+    السجل ينتهي بعد CACHE_TTL أو عند أي تعديل، والأقدم استخداماً ينحذف إذا تجاوزنا CACHE_MAX_ENTRIES.
+    النتيجة مشتركة بين المستدعين، فلا تعدّل عليها.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with _cache_lock:
+            entry = _cache.get(key)
+            if entry and entry[0] == _catalog_version and entry[1] > now:
+                _cache.move_to_end(key)
+                return entry[2]
+            version = _catalog_version
         
-        # جدول المجهزين (Agents)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS Agents (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT UNIQUE,
-                name TEXT NOT NULL,
-                secret_code TEXT NOT NULL UNIQUE
-            )
-        """)
+        _query_state.failed = False
+        value = func(*args, **kwargs)
+        if _query_state.failed:
+            return value # لا نخزن نتيجة استعلام فاشل
         
-        # جدول ربط المحلات والمجهزين (AgentShops)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS AgentShops (
-                agent_id INTEGER REFERENCES Agents(id) ON DELETE CASCADE,
-                shop_id INTEGER REFERENCES Shops(id) ON DELETE CASCADE,
-                PRIMARY KEY (agent_id, shop_id)
-            )
-        """)
-        conn.commit()
+        with _cache_lock:
+            # إذا صار تعديل أثناء القراءة، النتيجة قد تكون قديمة فما نخزنها
+            if version == _catalog_version:
+                _cache[key] = (version, now + CACHE_TTL, value)
+                _cache.move_to_end(key)
+                while len(_cache) > CACHE_MAX_ENTRIES:
+                    _cache.popitem(last=False)
+        return value
+    return wrapper
+
+def invalidates_catalog(func):
+    """
+    تفرغ الكاش بعد تنفيذ دالة تعدّل على المحلات أو المجهزين، بس إذا فعلاً تغير شي:
+    النتيجة CREATED أو UPDATED أو DELETED، أو مجموعة غير فارغة (add_shops_bulk)، أو صار استثناء (ما نعرف).
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            invalidate_catalog()
+            raise
+        changed = result in _CHANGED_RESULTS if isinstance(result, str) else bool(result)
+        if changed:
+            invalidate_catalog()
+        return result
+    return wrapper
+
+def setup_db():
+    """
+    تجهيز قاعدة البيانات عند التشغيل: تطبيق الترحيلات الناقصة (migrations.py) وتفعيل بحث pg_trgm.
+    إذا القاعدة محدثة ما ينفذ أي DDL.
+    """
+    try:
+        with get_connection() as conn:
+            version = apply_migrations(conn)
+            logger.info(f"Database schema version {version}")
+            
+            if SHOP_SEARCH_MODE == 'trigram':
+                _setup_trigram_search(conn)
         
     except Exception as e:
         logger.error(f"Error setting up database: {e}")
-    finally:
-        if conn:
-            conn.close()
+
+def _setup_trigram_search(conn):
+    """تنشئ امتداد pg_trgm وفهرس GIN على اسم المحل. إذا فشلت يرجع البحث لـ ILIKE."""
+    global _trigram_available
+    try:
+        with conn.cursor() as cursor:
+            # الفهرس موجود من تشغيل سابق، فما نحتاج DDL
+            cursor.execute("SELECT to_regclass('idx_shops_name_trgm') IS NOT NULL")
+            if cursor.fetchone()[0]:
+                conn.commit()
+                _trigram_available = True
+                return
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_shops_name_trgm ON Shops USING gin (name gin_trgm_ops)")
+        conn.commit()
+        _trigram_available = True
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.warning(f"pg_trgm is not available, falling back to ILIKE search: {e}")
+
+# ------------------------------------------------------------------------------------------------
+# نتائج عمليات الكتابة
+# ------------------------------------------------------------------------------------------------
+
+# دوال الإضافة والتعديل والحذف ترجع وحدة من هذي القيم بدل True/False،
+# حتى المعالج يعرف سبب الفشل بدون استعلام ثاني
+CREATED = "CREATED"
+UPDATED = "UPDATED"
+DELETED = "DELETED"
+NAME_EXISTS = "NAME_EXISTS"
+CODE_EXISTS = "CODE_EXISTS"
+NOT_FOUND = "NOT_FOUND"
+DB_ERROR = "DB_ERROR"
+# النتائج اللي معناها إن البيانات تغيرت فعلاً (الكاش ينفرغ بس وياها)
+_CHANGED_RESULTS = (CREATED, UPDATED, DELETED)
+
+# اسم قيد UNIQUE (حسب تسمية Postgres الافتراضية) -> النتيجة
+_UNIQUE_VIOLATIONS = {
+    'shops_name_key': NAME_EXISTS,
+    'agents_secret_code_key': CODE_EXISTS,
+}
+
+def _write(query: str, params: tuple, success: str, no_row: str) -> str:
+    """
+    تنفذ أمر كتابة واحد فيه RETURNING. ترجع success إذا رجع صف، و no_row إذا ما رجع
+    (ما موجود، أو ON CONFLICT DO NOTHING)، واسم القيد المخالف إذا صار UniqueViolation.
+    """
+    try:
+        with transaction() as cursor:
+            cursor.execute(query, params)
+            row = cursor.fetchone()
+        return success if row else no_row
+    except psycopg2.errors.UniqueViolation as e:
+        return _UNIQUE_VIOLATIONS.get(e.diag.constraint_name, DB_ERROR)
+    except Exception as e:
+        logger.error(f"DB Error executing write: {e}")
+        return DB_ERROR
 
 # ------------------------------------------------------------------------------------------------
 # دوال المحلات (Shops)
 # ------------------------------------------------------------------------------------------------
 
+@invalidates_catalog
 def add_shop(name: str, url: str):
-    """إضافة محل جديد إلى قاعدة البيانات."""
-    query = "INSERT INTO Shops (name, url) VALUES (%s, %s)"
-    return execute_query(query, (name, url))
+    """إضافة محل جديد إلى قاعدة البيانات. ترجع CREATED أو NAME_EXISTS أو DB_ERROR."""
+    query = "INSERT INTO Shops (name, url) VALUES (%s, %s) ON CONFLICT (name) DO NOTHING RETURNING id"
+    return _write(query, (name, url), CREATED, NAME_EXISTS)
 
+@invalidates_catalog
+def add_shops_bulk(shops: list):
+    """
+    إضافة مجموعة محلات [(name, url), ...] بأمر INSERT واحد متعدد الصفوف.
+    المحلات اللي اسمها موجود مسبقاً يتم تجاهلها. ترجع مجموعة أسماء المحلات المضافة فعلاً، أو None عند الخطأ.
+    """
+    if not shops:
+        return set()
+    query = "INSERT INTO Shops (name, url) VALUES %s ON CONFLICT (name) DO NOTHING RETURNING name"
+    try:
+        with transaction() as cursor:
+            # page_size = عدد الصفوف حتى يروح الكل بأمر واحد
+            rows = cursor.execute_values(query, shops, page_size=len(shops), fetch=True)
+        return {row[0] for row in rows}
+    except Exception as e:
+        logger.error(f"DB Error in add_shops_bulk: {e}")
+        return None
+
+@cached_read
 def get_all_shops():
     """جلب جميع المحلات."""
     query = "SELECT id, name, url FROM Shops ORDER BY name"
-    return execute_query(query, fetch_all=True)
+    return execute_query(query, fetch_all=True, read_only=True)
 
+@invalidates_catalog
 def update_shop_details(shop_id, new_name, new_url):
-    """تحديث اسم ورابط محل محدد."""
-    query = "UPDATE Shops SET name = %s, url = %s WHERE id = %s"
-    return execute_query(query, (new_name, new_url, shop_id))
+    """تحديث اسم ورابط محل محدد. ترجع UPDATED أو NAME_EXISTS أو NOT_FOUND أو DB_ERROR."""
+    query = "UPDATE Shops SET name = %s, url = %s WHERE id = %s RETURNING id"
+    return _write(query, (new_name, new_url, shop_id), UPDATED, NOT_FOUND)
 
+@invalidates_catalog
 def delete_shop(shop_id):
-    """حذف محل محدد بواسطة ID وحذف كل ارتباطاته بالمجهزين."""
-    try:
-        # 1. حذف ارتباطات المجهزين أولاً (AgentShops)
-        delete_assignments_query = "DELETE FROM AgentShops WHERE shop_id = %s"
-        execute_query(delete_assignments_query, (shop_id,))
-        
-        # 2. حذف المحل نفسه (Shops)
-        delete_shop_query = "DELETE FROM Shops WHERE id = %s"
-        execute_query(delete_shop_query, (shop_id,))
-        
-        return True
-    except Exception as e:
-        logger.error(f"Error deleting shop {shop_id}: {e}")
-        return False
+    """
+    حذف محل محدد بواسطة ID. ترجع DELETED أو NOT_FOUND أو DB_ERROR.
+    ارتباطات المجهزين (AgentShops) تنحذف ويا المحل عبر ON DELETE CASCADE.
+    """
+    return _write("DELETE FROM Shops WHERE id = %s RETURNING id", (shop_id,), DELETED, NOT_FOUND)
 
 # ------------------------------------------------------------------------------------------------
 # دوال المجهزين (Agents)
 # ------------------------------------------------------------------------------------------------
 
+@invalidates_catalog
 def add_agent(name: str, secret_code: str):
-    """إضافة مجهز جديد."""
-    query = "INSERT INTO Agents (name, secret_code) VALUES (%s, %s)"
-    return execute_query(query, (name, secret_code))
+    """إضافة مجهز جديد. ترجع CREATED أو CODE_EXISTS أو DB_ERROR."""
+    query = "INSERT INTO Agents (name, secret_code) VALUES (%s, %s) ON CONFLICT (secret_code) DO NOTHING RETURNING id"
+    return _write(query, (name, hash_secret_code(secret_code)), CREATED, CODE_EXISTS)
 
+@cached_read
 def get_all_agents():
     """جلب جميع المجهزين."""
     query = "SELECT id, name FROM Agents ORDER BY name"
-    return execute_query(query, fetch_all=True)
+    return execute_query(query, fetch_all=True, read_only=True)
 
+@cached_read
 def get_agent_name_by_id(agent_id: int):
     """جلب اسم مجهز بواسطة ID."""
     query = "SELECT name FROM Agents WHERE id = %s"
-    result = execute_query(query, (agent_id,), fetch_one=True)
+    result = execute_query(query, (agent_id,), fetch_one=True, read_only=True)
     return result['name'] if result else None
 
+@invalidates_catalog
 def update_agent_details(agent_id, new_name, new_code):
-    """تحديث اسم ورمز الدخول لمجهز محدد بواسطة ID."""
-    
-    # استعلام للتحقق من أن الرمز الجديد غير مستخدم من قبل مجهز آخر
-    check_query = """
-        SELECT id FROM Agents WHERE secret_code = %s AND id != %s
-    """
-    # استعلام لتحديث الاسم والرمز
-    update_query = """
-        UPDATE Agents 
-        SET name = %s, secret_code = %s 
+    """
+    تحديث اسم ورمز الدخول لمجهز محدد بواسطة ID بأمر واحد.
+    ترجع UPDATED أو CODE_EXISTS (الرمز مستخدم لمجهز ثاني، حسب قيد UNIQUE) أو NOT_FOUND أو DB_ERROR.
+    إذا تغير الرمز ينفك ربط حساب تيليجرام، فالمجهز لازم يدخل بالرمز الجديد.
+    """
+    query = """
+        UPDATE Agents
+        SET name = %s, secret_code = %s,
+            telegram_id = CASE WHEN secret_code = %s THEN telegram_id END
         WHERE id = %s
+        RETURNING telegram_id
     """
+    code_hash = hash_secret_code(new_code)
     try:
-        # 1. التحقق من الرمز
-        existing_agent = execute_query(check_query, (new_code, agent_id), fetch_one=True)
-        if existing_agent:
-            return "CODE_EXISTS" # رمز الدخول مستخدم بالفعل
-            
-        # 2. تنفيذ التحديث
-        execute_query(update_query, (new_name, new_code, agent_id))
-        return True
+        with transaction() as cursor:
+            cursor.execute(query, (new_name, code_hash, code_hash, agent_id))
+            row = cursor.fetchone()
+    except psycopg2.errors.UniqueViolation as e:
+        return _UNIQUE_VIOLATIONS.get(e.diag.constraint_name, DB_ERROR)
     except Exception as e:
         logger.error(f"Error updating agent details: {e}")
-        return False
+        return DB_ERROR
+
+    if row is None:
+        _update_agent_sessions(agent_id, remove=True)
+        return NOT_FOUND
+    if row[0] is None:
+        _update_agent_sessions(agent_id, remove=True)
+    else:
+        _update_agent_sessions(agent_id, name=new_name)
+    return UPDATED
 
 # 🚨 التعديل الذي يمنع خطأ TypeError
+@invalidates_catalog
 def delete_agent(agent_id=None):
-    """حذف مجهز محدد بواسطة ID وحذف كل ارتباطاته بالمحلات."""
+    """
+    حذف مجهز محدد بواسطة ID. ترجع DELETED أو NOT_FOUND أو DB_ERROR.
+    ارتباطات المحلات (AgentShops) تنحذف ويا المجهز عبر ON DELETE CASCADE.
+    """
     # منع الخطأ إذا تم استدعاء الدالة بدون ID
     if agent_id is None:
-        return False
-        
-    try:
-        # 1. حذف ارتباطات المحلات أولاً (AgentShops)
-        delete_assignments_query = "DELETE FROM AgentShops WHERE agent_id = %s"
-        execute_query(delete_assignments_query, (agent_id,))
-        
-        # 2. حذف المجهز نفسه (Agents)
-        delete_agent_query = "DELETE FROM Agents WHERE id = %s"
-        execute_query(delete_agent_query, (agent_id,))
-        
-        return True
-    except Exception as e:
-        logger.error(f"Error deleting agent {agent_id}: {e}")
-        return False
+        return NOT_FOUND
+    result = _write("DELETE FROM Agents WHERE id = %s RETURNING id", (agent_id,), DELETED, NOT_FOUND)
+    if result != DB_ERROR:
+        _update_agent_sessions(agent_id, remove=True)
+    return result
 
 # ------------------------------------------------------------------------------------------------
 # دوال الربط (Assignment)
@@ -204,10 +670,11 @@ def delete_agent(agent_id=None):
 def get_assigned_shop_ids(agent_id: int):
     """جلب قائمة بـ ID المحلات المخصصة لمجهز معين."""
     query = "SELECT shop_id FROM AgentShops WHERE agent_id = %s"
-    results = execute_query(query, (agent_id,), fetch_all=True)
+    results = execute_query(query, (agent_id,), fetch_all=True, read_only=True)
     # تحويل قائمة القواميس إلى قائمة من الأرقام الصحيحة
     return [row['shop_id'] for row in results] if results else []
 
+@marks_write
 def toggle_agent_shop_assignment(agent_id: int, shop_id: int, assign: bool):
     """ربط أو إلغاء ربط محل بمجهز محدد."""
     if assign:
@@ -217,6 +684,81 @@ def toggle_agent_shop_assignment(agent_id: int, shop_id: int, assign: bool):
         
     return execute_query(query, (agent_id, shop_id))
 
+@marks_write
+def _bulk_assignment(query: str, params: tuple):
+    """تنفذ أمر ربط/إلغاء ربط بالجملة وترجع قائمة ID المحلات اللي تغيرت، أو None عند الخطأ."""
+    results = execute_query(query, params, fetch_all=True)
+    if results is False:
+        return None
+    return [row['shop_id'] for row in results]
+
+def assign_all_shops(agent_id: int):
+    """ربط كل المحلات بالمجهز بأمر واحد. ترجع ID المحلات المربوطة حديثاً."""
+    query = """
+        INSERT INTO AgentShops (agent_id, shop_id)
+        SELECT %s, id FROM Shops
+        ON CONFLICT DO NOTHING
+        RETURNING shop_id
+    """
+    return _bulk_assignment(query, (agent_id,))
+
+def unassign_all_shops(agent_id: int):
+    """إلغاء ربط كل المحلات من المجهز بأمر واحد. ترجع ID المحلات اللي انلغى ربطها."""
+    query = "DELETE FROM AgentShops WHERE agent_id = %s RETURNING shop_id"
+    return _bulk_assignment(query, (agent_id,))
+
+def assign_shops_by_search(agent_id: int, search_term: str, assign: bool):
+    """ربط أو إلغاء ربط كل المحلات اللي اسمها يحتوي نص البحث بأمر واحد. ترجع ID المحلات اللي تغيرت."""
+    # نهرب رموز LIKE حتى "_" أو "%" ما تطابق كل المحلات
+    escaped = search_term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    search_pattern = f"%{escaped}%"
+    if assign:
+        query = r"""
+            INSERT INTO AgentShops (agent_id, shop_id)
+            SELECT %s, id FROM Shops WHERE name ILIKE %s ESCAPE '\'
+            ON CONFLICT DO NOTHING
+            RETURNING shop_id
+        """
+    else:
+        query = r"""
+            DELETE FROM AgentShops AS A
+            USING Shops AS S
+            WHERE A.shop_id = S.id AND A.agent_id = %s AND S.name ILIKE %s ESCAPE '\'
+            RETURNING A.shop_id
+        """
+    return _bulk_assignment(query, (agent_id, search_pattern))
+
+def copy_agent_assignments(source_agent_id: int, target_agent_id: int):
+    """تربط بالمجهز الهدف كل المحلات المربوطة بالمجهز المصدر (مع الإبقاء على ربطه الحالي). ترجع ID المحلات المربوطة حديثاً."""
+    query = """
+        INSERT INTO AgentShops (agent_id, shop_id)
+        SELECT %s, shop_id FROM AgentShops WHERE agent_id = %s
+        ON CONFLICT DO NOTHING
+        RETURNING shop_id
+    """
+    return _bulk_assignment(query, (target_agent_id, source_agent_id))
+
+@marks_write
+def toggle_agent_shop(agent_id: int, shop_id: int):
+    """
+    تقلب ربط المحل بالمجهز باستعلام واحد: إذا مربوط تلغي الربط، وإذا مو مربوط تربطه.
+    ترجع الحالة الجديدة (True = مربوط) أو None عند الخطأ.
+    """
+    query = """
+        WITH deleted AS (
+            DELETE FROM AgentShops WHERE agent_id = %s AND shop_id = %s
+            RETURNING shop_id
+        ), inserted AS (
+            INSERT INTO AgentShops (agent_id, shop_id)
+            SELECT %s, %s WHERE NOT EXISTS (SELECT 1 FROM deleted)
+            ON CONFLICT DO NOTHING
+            RETURNING shop_id
+        )
+        SELECT EXISTS (SELECT 1 FROM inserted) AS assigned
+    """
+    result = execute_query(query, (agent_id, shop_id, agent_id, shop_id), fetch_one=True)
+    return result['assigned'] if result else None
+
 # ------------------------------------------------------------------------------------------------
 # دوال تسجيل الدخول والبحث
 # ------------------------------------------------------------------------------------------------
@@ -228,50 +770,378 @@ def check_agent_code(agent_code: str):
     try:
         agent = execute_query(
             "SELECT id, telegram_id, name FROM Agents WHERE secret_code = %s", 
-            (agent_code,), 
-            fetch_one=True
+            (hash_secret_code(agent_code),), 
+            fetch_one=True,
+            read_only=True
         )
         return agent # ترجع قاموس أو None
     except Exception:
         return None
 
-def get_agent_shops_by_search(agent_id: int, search_term: str):
+# ------------------------------------------------------------------------------------------------
+# فهرس جلسات المجهزين (telegram_id -> المجهز) بالذاكرة
+# ------------------------------------------------------------------------------------------------
+# يتعبى مرة وحدة عند التشغيل ويتحدث مع كل تسجيل دخول أو تعديل أو حذف،
+# فالتعرف على المجهز العائد عند /start ما يحتاج استعلام.
+
+_agent_sessions = None # telegram_id -> {'id', 'name'}، أو None قبل التحميل
+_agent_sessions_lock = threading.Lock()
+
+def _fetch_agent_sessions():
+    rows = execute_query(
+        "SELECT telegram_id, id, name FROM Agents WHERE telegram_id IS NOT NULL", fetch_all=True
+    )
+    if rows is False:
+        return None
+    return {row['telegram_id']: {'id': row['id'], 'name': row['name']} for row in rows}
+
+def load_agent_sessions():
+    """تحمل كل المجهزين اللي عندهم telegram_id للفهرس. ترجع عددهم، أو None عند الخطأ."""
+    global _agent_sessions
+    sessions = _fetch_agent_sessions()
+    if sessions is None:
+        return None
+    with _agent_sessions_lock:
+        _agent_sessions = sessions
+        return len(sessions)
+
+def get_agent_by_telegram_id(telegram_id: int):
+    """المجهز المربوط بحساب تيليجرام هذا (قاموس فيه id و name)، أو None."""
+    global _agent_sessions
+    # apply_remote_change (بخيط db-changes) ممكن يفرغ الفهرس بأي لحظة، فنقرا مرجعه تحت القفل ونكمل بيه
+    with _agent_sessions_lock:
+        sessions = _agent_sessions
+    if sessions is None:
+        sessions = _fetch_agent_sessions()
+        if sessions is None:
+            return None
+        with _agent_sessions_lock:
+            if _agent_sessions is None:
+                _agent_sessions = sessions
+    with _agent_sessions_lock:
+        agent = sessions.get(telegram_id)
+        return dict(agent) if agent else None
+
+def _update_agent_sessions(agent_id: int, telegram_id: int = None, name: str = None, remove: bool = False):
+    """تحدث الفهرس بعد تغيير بقاعدة البيانات (ربط حساب، تغيير اسم، أو حذف المجهز)."""
+    with _agent_sessions_lock:
+        if _agent_sessions is None:
+            return
+        for key in [key for key, agent in _agent_sessions.items() if agent['id'] == agent_id]:
+            if remove or telegram_id is not None:
+                del _agent_sessions[key]
+            elif name is not None:
+                _agent_sessions[key]['name'] = name
+        if telegram_id is not None and not remove:
+            _agent_sessions[telegram_id] = {'id': agent_id, 'name': name}
+
+def set_agent_telegram_id(agent_id: int, telegram_id: int, name: str):
     """
-    تجلب المحلات المخصصة لمجهز معين والتي يتطابق اسمها جزئياً مع نص البحث.
+    تسجل حساب تيليجرام اللي دخل بيه المجهز (للإشعارات والدخول التلقائي).
+    إذا نفس الحساب كان مربوط بمجهز ثاني ينشال منه أولاً (العمود UNIQUE).
+    ترجع True إذا انربط الحساب، و False إذا المجهز ما موجود أو صار خطأ.
     """
     try:
+        with transaction() as cursor:
+            # ما نشيل الحساب من المجهز الثاني إذا المجهز المطلوب انحذف بالأثناء
+            cursor.execute(
+                "UPDATE Agents SET telegram_id = NULL WHERE telegram_id = %s AND id <> %s "
+                "AND EXISTS (SELECT 1 FROM Agents WHERE id = %s)",
+                (telegram_id, agent_id, agent_id)
+            )
+            cursor.execute(
+                "UPDATE Agents SET telegram_id = %s WHERE id = %s AND telegram_id IS DISTINCT FROM %s",
+                (telegram_id, agent_id, telegram_id)
+            )
+            updated = cursor.rowcount == 1
+        if not updated:
+            # المجهز انحذف (أو الحساب مربوط بيه أصلاً): ما نضيف للفهرس مجهز ممكن ما موجود
+            return False
+        _update_agent_sessions(agent_id, telegram_id=telegram_id, name=name)
+        _publish_change(CHANGE_SESSIONS)
+        return True
+    except Exception as e:
+        logger.error(f"Error saving telegram_id for agent {agent_id}: {e}")
+        return False
+
+def get_agent_telegram_ids(shop_ids: list = None):
+    """
+    حسابات تيليجرام للمجهزين اللي سجلوا دخول: الكل، أو (إذا انطت shop_ids) بس المربوطين بهالمحلات.
+    ترجع قائمة أرقام، أو None عند الخطأ.
+    """
+    if shop_ids is None:
+        query = "SELECT telegram_id FROM Agents WHERE telegram_id IS NOT NULL"
+        params = None
+    else:
         query = """
-            SELECT T1.id, T1.name, T1.url 
-            FROM Shops AS T1
-            JOIN AgentShops AS T2 ON T1.id = T2.shop_id
-            WHERE T2.agent_id = %s AND T1.name ILIKE %s
-            ORDER BY T1.name
+            SELECT DISTINCT A.telegram_id FROM Agents A
+            JOIN AgentShops AS ASH ON A.id = ASH.agent_id
+            WHERE ASH.shop_id = ANY(%s) AND A.telegram_id IS NOT NULL
         """
-        search_pattern = f"%{search_term}%" 
-        
-        results = execute_query(query, (agent_id, search_pattern), fetch_all=True)
-        
-        return results if results else []
+        params = (list(shop_ids),)
+    rows = execute_query(query, params, fetch_all=True)
+    if rows is False:
+        return None
+    return [row['telegram_id'] for row in rows]
+
+def clear_agent_telegram_ids(telegram_ids: list):
+    """تشيل حسابات تيليجرام اللي ما عادت تستقبل رسائل (حظرت البوت أو انحذفت)."""
+    if not telegram_ids:
+        return True
+    query = "UPDATE Agents SET telegram_id = NULL WHERE telegram_id = ANY(%s)"
+    result = execute_query(query, (list(telegram_ids),))
+    if result:
+        with _agent_sessions_lock:
+            if _agent_sessions is not None:
+                for telegram_id in telegram_ids:
+                    _agent_sessions.pop(telegram_id, None)
+        _publish_change(CHANGE_SESSIONS)
+    return result
+
+def _search_shops(search_term: str, agent_id: int = None, limit: int = SEARCH_RESULT_LIMIT):
+    """
+    تبحث عن المحلات بالاسم (وإذا انطى agent_id فقط بالمحلات المخصصة له).
+    مع pg_trgm: تطابق تقريبي يستخدم فهرس GIN، والنتائج مرتبة حسب درجة التشابه (الأفضل أولاً).
+    بدونه: بحث جزئي بـ ILIKE مرتب بالاسم.
+    """
+    search_pattern = f"%{search_term}%"
+    join = ""
+    conditions = []
+    params = []
+    if agent_id is not None:
+        join = "JOIN AgentShops AS A ON A.shop_id = S.id"
+        conditions.append("A.agent_id = %s")
+        params.append(agent_id)
+    
+    if _trigram_available:
+        # الحد الأدنى للتشابه ينضبط لنفس الـ transaction فقط، وبنفس الرحلة للقاعدة
+        query = f"""
+            SELECT set_config('pg_trgm.word_similarity_threshold', %s, true);
+            SELECT S.id, S.name, S.url
+            FROM Shops AS S
+            {join}
+            WHERE {" AND ".join(conditions + ["(%s <%% S.name OR S.name ILIKE %s)"])}
+            ORDER BY (S.name ILIKE %s) DESC, word_similarity(%s, S.name) DESC, S.name, S.id
+            LIMIT %s
+        """
+        params = [str(SEARCH_SIMILARITY_THRESHOLD)] + params + [search_term, search_pattern, search_pattern, search_term, limit]
+    else:
+        query = f"""
+            SELECT S.id, S.name, S.url
+            FROM Shops AS S
+            {join}
+            WHERE {" AND ".join(conditions + ["S.name ILIKE %s"])}
+            ORDER BY S.name, S.id
+            LIMIT %s
+        """
+        params = params + [search_pattern, limit]
+    
+    results = execute_query(query, tuple(params), fetch_all=True, read_only=True)
+    return results if results else []
+
+def get_agent_shops_by_search(agent_id: int, search_term: str, limit: int = SEARCH_RESULT_LIMIT):
+    """
+    تجلب المحلات المخصصة لمجهز معين والأقرب لنص البحث (الأفضل أولاً).
+    """
+    try:
+        return _search_shops(search_term, agent_id=agent_id, limit=limit)
     except Exception as e:
         logger.error(f"DB Error in get_agent_shops_by_search: {e}")
         return []
 
-def get_shops_by_search(search_term: str):
+def get_shops_by_search(search_term: str, limit: int = SEARCH_RESULT_LIMIT):
     """
-    تجلب المحلات التي يتطابق اسمها جزئياً مع نص البحث للمدير.
+    تجلب المحلات الأقرب لنص البحث للمدير (الأفضل أولاً).
     """
     try:
-        query = """
-            SELECT id, name, url 
-            FROM Shops 
-            WHERE name ILIKE %s
-            ORDER BY name
-        """
-        search_pattern = f"%{search_term}%" 
-        
-        results = execute_query(query, (search_pattern,), fetch_all=True)
-        
-        return results if results else []
+        return _search_shops(search_term, limit=limit)
     except Exception as e:
         logger.error(f"DB Error in get_shops_by_search: {e}")
         return []
+
+def get_agent_shops_by_prefix(agent_id: int, prefix: str, limit: int = INLINE_RESULT_LIMIT):
+    """
+    تجلب محلات المجهز اللي اسمها يبدأ بالنص المكتوب (بدون تفريق بين الأحرف الكبيرة والصغيرة).
+    مخصصة للبحث السريع بالـ Inline Mode، والنص الفارغ يرجع أول المحلات بالترتيب.
+    """
+    # نهرب رموز LIKE حتى تنبحث كنص عادي
+    escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    query = """
+        SELECT S.id, S.name, S.url
+        FROM AgentShops AS A
+        JOIN Shops AS S ON S.id = A.shop_id
+        WHERE A.agent_id = %s AND lower(S.name) LIKE lower(%s) || '%%'
+        ORDER BY S.name, S.id
+        LIMIT %s
+    """
+    results = execute_query(query, (agent_id, escaped, limit), fetch_all=True, read_only=True)
+    return results if results else []
+
+# ------------------------------------------------------------------------------------------------
+# دوال التقسيم لصفحات (Keyset Pagination)
+# ------------------------------------------------------------------------------------------------
+
+def _fetch_shops_page(select_query: str, select_params: list, conditions: list, params: list,
+                      after: tuple = None, before: tuple = None, limit: int = SHOPS_PAGE_SIZE):
+    """
+    تجلب صفحة واحدة من المحلات مرتبة بـ (name, id) باستخدام keyset pagination.
+    after: (name, id) لآخر محل بالصفحة السابقة (للصفحة التالية)، before: (name, id) لأول محل بالصفحة الحالية
+    (للصفحة السابقة). المؤشر يحمل الاسم نفسه، فتغيير اسم المحل أو حذفه ما يغير مكان الصفحة.
+    ترجع (المحلات، هل توجد صفحة سابقة، هل توجد صفحة تالية).
+    الاستعلام لازم يسمي جدول المحلات بـ S.
+    """
+    conditions = list(conditions)
+    params = list(select_params) + list(params)
+    
+    if after is not None:
+        conditions.append("(S.name, S.id) > (%s, %s)")
+        params.extend(after)
+        order = "S.name, S.id"
+    elif before is not None:
+        conditions.append("(S.name, S.id) < (%s, %s)")
+        params.extend(before)
+        order = "S.name DESC, S.id DESC"
+    else:
+        order = "S.name, S.id"
+    
+    query = select_query
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    # نجلب سطراً زائداً حتى نعرف إذا اكو صفحة بعدها بدون COUNT
+    query += f" ORDER BY {order} LIMIT %s"
+    params.append(limit + 1)
+    
+    rows = execute_query(query, tuple(params), fetch_all=True, read_only=True) or []
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    if before is not None:
+        rows.reverse()
+        return rows, has_more, True
+    return rows, after is not None, has_more
+
+@cached_read
+def get_shops_page(after: tuple = None, before: tuple = None, limit: int = SHOPS_PAGE_SIZE):
+    """صفحة من كل المحلات للمدير."""
+    return _fetch_shops_page(
+        "SELECT S.id, S.name, S.url FROM Shops AS S", [],
+        [], [], after, before, limit
+    )
+
+def get_agent_shops_page(agent_id: int, after: tuple = None, before: tuple = None, limit: int = SHOPS_PAGE_SIZE):
+    """صفحة من المحلات المخصصة لمجهز معين."""
+    return _fetch_shops_page(
+        "SELECT S.id, S.name, S.url FROM Shops AS S JOIN AgentShops AS A ON A.shop_id = S.id", [],
+        ["A.agent_id = %s"], [agent_id], after, before, limit
+    )
+
+# ------------------------------------------------------------------------------------------------
+# دوال حفظ حالة البوت (Persistence)
+# ------------------------------------------------------------------------------------------------
+
+def load_persistence(kind: str):
+    """تجلب كل السجلات المحفوظة من نوع معين (user_data، chat_data، conversation:...) كقاموس key -> bytes."""
+    results = execute_query("SELECT key, data FROM BotPersistence WHERE kind = %s", (kind,), fetch_all=True)
+    if results is False:
+        raise psycopg2.OperationalError(f"Could not load persisted {kind}.")
+    return {row['key']: bytes(row['data']) for row in results}
+
+def save_persistence(upserts: list, deletes: list):
+    """
+    تحفظ دفعة كاملة من التغييرات بـ transaction واحد:
+    upserts = [(kind, key, bytes)] تنضاف أو تتحدث، deletes = [(kind, key)] تنحذف.
+    """
+    with transaction() as cursor:
+        _save_persistence_rows(cursor, upserts, deletes)
+
+def _save_persistence_rows(cursor, upserts: list, deletes: list):
+    if upserts:
+        cursor.execute_values(
+            "INSERT INTO BotPersistence (kind, key, data) VALUES %s "
+            "ON CONFLICT (kind, key) DO UPDATE SET data = EXCLUDED.data",
+            [(kind, key, psycopg2.Binary(data)) for kind, key, data in upserts],
+            page_size=len(upserts)
+        )
+    if deletes:
+        cursor.execute_values(
+            "DELETE FROM BotPersistence AS P USING (VALUES %s) AS D (kind, key) "
+            "WHERE P.kind = D.kind AND P.key = D.key",
+            deletes,
+            page_size=len(deletes)
+        )
+
+# ------------------------------------------------------------------------------------------------
+# دوال وضع النسخ المتعددة (إيجار المستخدم ومنع تكرار التحديثات)
+# ------------------------------------------------------------------------------------------------
+
+DUPLICATE_UPDATE = "DUPLICATE_UPDATE"
+LEASE_BUSY = "LEASE_BUSY"
+
+def begin_shared_update(update_id: int, lease_key: str, owner: str, lease_seconds: float, state_keys: list):
+    """
+    تبدأ معالجة تحديث بوضع النسخ المتعددة، بـ transaction واحد:
+    تاخذ إيجار (lease_key) إذا فاضي أو منتهي، تتأكد إن update_id ما انعالج قبل، وتجلب حالة المستخدم المحفوظة.
+    update_id ما ينسجل هنا بل بـ end_shared_update، فإذا النسخة وقفت أثناء المعالجة التحديث ينعاد (مرة على الأقل).
+    ترجع LEASE_BUSY (نسخة ثانية تعالج نفس المستخدم، ما تغير شي)، أو DUPLICATE_UPDATE (التحديث انعالج قبل)،
+    أو قاموس (kind, key) -> bytes للسجلات الموجودة من state_keys = [(kind, key)].
+    lease_key = None يعني بدون إيجار (تحديث ما يخص مستخدم)، و update_id = None بدون فحص التكرار.
+    """
+    with transaction() as cursor:
+        if lease_key is not None:
+            cursor.execute("""
+                INSERT INTO UpdateLeases (key, owner, expires_at)
+                VALUES (%s, %s, now() + make_interval(secs => %s))
+                ON CONFLICT (key) DO UPDATE SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at
+                WHERE UpdateLeases.owner = EXCLUDED.owner OR UpdateLeases.expires_at < now()
+                RETURNING key
+            """, (lease_key, owner, lease_seconds))
+            if cursor.fetchone() is None:
+                return LEASE_BUSY
+
+        if update_id is not None:
+            cursor.execute("SELECT 1 FROM ProcessedUpdates WHERE update_id = %s", (update_id,))
+            if cursor.fetchone() is not None:
+                if lease_key is not None:
+                    cursor.execute("DELETE FROM UpdateLeases WHERE key = %s AND owner = %s", (lease_key, owner))
+                return DUPLICATE_UPDATE
+
+        if not state_keys:
+            return {}
+        cursor.execute_values(
+            "SELECT P.kind, P.key, P.data FROM BotPersistence AS P "
+            "JOIN (VALUES %s) AS K (kind, key) ON P.kind = K.kind AND P.key = K.key",
+            state_keys,
+            page_size=len(state_keys)
+        )
+        return {(kind, key): bytes(data) for kind, key, data in cursor.fetchall()}
+
+def renew_update_lease(lease_key: str, owner: str, lease_seconds: float) -> bool:
+    """تمدد الإيجار (للمعالجات الطويلة). ترجع False إذا الإيجار ما عاد إلنا."""
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE UpdateLeases SET expires_at = now() + make_interval(secs => %s) WHERE key = %s AND owner = %s",
+            (lease_seconds, lease_key, owner)
+        )
+        return cursor.rowcount == 1
+
+def end_shared_update(update_id: int, lease_key: str, owner: str, upserts: list, deletes: list):
+    """
+    تسجل update_id كمعالج، تحفظ حالة المستخدم اللي تغيرت وتفك الإيجار بـ transaction واحد.
+    الإيجار يخلي إعادة إرسال نفس التحديث تنتظر لحد هنا، فتلقاه مسجل وما ينعالج مرتين
+    (التحديثات اللي ما تخص مستخدم ما إلها إيجار، فممكن تنعالج مرتين إذا انعادت أثناء المعالجة).
+    """
+    with transaction() as cursor:
+        if update_id is not None:
+            cursor.execute(
+                "INSERT INTO ProcessedUpdates (update_id) VALUES (%s) ON CONFLICT DO NOTHING", (update_id,)
+            )
+        _save_persistence_rows(cursor, upserts, deletes)
+        if lease_key is not None:
+            cursor.execute("DELETE FROM UpdateLeases WHERE key = %s AND owner = %s", (lease_key, owner))
+
+def prune_processed_updates(retention_seconds: float):
+    """تحذف سجلات التحديثات المعالجة الأقدم من retention_seconds (تيليجرام ما يعيد إرسالها بعدها)."""
+    return execute_query(
+        "DELETE FROM ProcessedUpdates WHERE processed_at < now() - make_interval(secs => %s)",
+        (retention_seconds,)
+    )
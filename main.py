@@ -1,33 +1,71 @@
 # main.py
 import os
+import re
+import asyncio
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InlineQueryResultsButton,
+    InputTextMessageContent
+)
 from telegram.ext import (
     Application,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     MessageHandler,
     filters
 )
 from database import (
-    setup_db, 
+    setup_db,
+    load_agent_sessions,
+    CREATED, UPDATED, DELETED, NAME_EXISTS, CODE_EXISTS, NOT_FOUND
+)
+from async_db import (
+    shutdown as shutdown_db,
+    run_db,
     add_shop, 
-    get_all_shops, 
     update_shop_details, 
     delete_shop,         
     add_agent, 
     get_all_agents, 
     get_agent_name_by_id,
     get_assigned_shop_ids, 
-    toggle_agent_shop_assignment,
+    toggle_agent_shop,
+    assign_all_shops,
+    unassign_all_shops,
+    assign_shops_by_search,
+    copy_agent_assignments,
     check_agent_code,
+    set_agent_telegram_id,
+    get_agent_by_telegram_id,
+    get_agent_telegram_ids,
+    clear_agent_telegram_ids,
     update_agent_details, 
     delete_agent,         
     get_agent_shops_by_search, 
-    get_shops_by_search        
+    get_shops_by_search,
+    get_agent_shops_by_prefix,
+    get_shops_page,
+    get_agent_shops_page
 ) 
+from shop_import import import_shops, iter_message_rows, iter_document_rows
+from update_processor import PerUserUpdateProcessor
+from replicas import MULTI_REPLICA, ReplicaCoordinator, start_change_listener
+from persistence import PostgresPersistence
+from metrics import MetricsServer, InstrumentedHTTPXRequest, instrument_application_handlers
+import query_profiler
+from render_cache import get_or_render
+from message_edits import edit_message, schedule_render
+from rate_limiter import TelegramRateLimiter, TELEGRAM_RATE_LIMIT
+from notifier import send_bulk
+from throttling import throttled
+from secret_codes import SECRET_CODE_PEPPER
 
 # تعريف حالات المحادثة
 (
@@ -65,6 +103,45 @@ def is_admin(user_id: int) -> bool:
     """التحقق ما إذا كان المستخدم يملك صلاحيات الإدارة."""
     return user_id in ADMIN_IDS
 
+def normalize_shop_url(url: str) -> str:
+    """تضيف https:// للرابط إذا كان بدون بروتوكول."""
+    if not url.lower().startswith(('http://', 'https://')):
+        return "https://" + url
+    return url
+
+# أكثر عدد مؤشرات صفحات نحفظها لكل مستخدم (حتى الأزرار على رسائل أقدم تبقى تشتغل)
+MAX_PAGE_CURSORS = 50
+
+def build_page_nav(prefix: str, shops: list, has_prev: bool, has_next: bool):
+    """
+    تبني صف أزرار (السابق/التالي) بـ callback_data مختصر يحمل ID أول/آخر محل بالصفحة.
+    ترجع (الصف، المؤشرات): المؤشرات قاموس callback_data -> (after, before) بـ (name, id)،
+    تنحفظ بـ remember_page_cursors حتى الصفحة ما تعتمد على اسم المحل الحالي.
+    """
+    row, cursors = [], {}
+    if shops and has_prev:
+        data = f"{prefix}_p_{shops[0]['id']}"
+        row.append(InlineKeyboardButton("⬅️ السابق", callback_data=data))
+        cursors[data] = (None, (shops[0]['name'], shops[0]['id']))
+    if shops and has_next:
+        data = f"{prefix}_n_{shops[-1]['id']}"
+        row.append(InlineKeyboardButton("التالي ➡️", callback_data=data))
+        cursors[data] = ((shops[-1]['name'], shops[-1]['id']), None)
+    return row, cursors
+
+def remember_page_cursors(user_data: dict, cursors: dict) -> None:
+    """تحفظ مؤشرات أزرار التنقل بالشاشة المعروضة بـ user_data (الأقدم ينحذف بعد MAX_PAGE_CURSORS)."""
+    saved = user_data.setdefault('page_cursors', {})
+    for data, cursor in cursors.items():
+        saved.pop(data, None)
+        saved[data] = cursor
+    while len(saved) > MAX_PAGE_CURSORS:
+        del saved[next(iter(saved))]
+
+def page_cursor(user_data: dict, data: str):
+    """(after, before) لزر التنقل data، أو (None, None) (الصفحة الأولى) إذا ما محفوظ."""
+    return user_data.get('page_cursors', {}).get(data, (None, None))
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يعرض قائمة البداية للمستخدم ويتعرف على المدير."""
     
@@ -86,7 +163,15 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         # ✅ المدير يدخل مباشرة إلى قائمة الإدارة
         return await show_admin_menu(update, context, is_command=True)
     
-    # 3. إذا لم يكن المدير، يتم عرض قائمة الدخول العادية
+    # 3. المجهز اللي سجل دخول قبل بنفس الحساب يدخل مباشرة (من الفهرس بالذاكرة)
+    agent = await get_agent_by_telegram_id(user_id)
+    if agent:
+        context.user_data['is_agent'] = True
+        context.user_data['agent_id'] = agent['id']
+        context.user_data['agent_name'] = agent['name']
+        return await show_agent_menu(update, context, is_login=True)
+    
+    # 4. إذا لم يكن مدير أو مجهز معروف، يتم عرض قائمة الدخول العادية
     keyboard = [
         [InlineKeyboardButton("إدخال رقمك السري 🔑", callback_data="agent_login_prompt")]
     ]
@@ -108,6 +193,70 @@ async def admin_login_command(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_text("❌ آسف، لا تملك صلاحية المدير.")
         return MAIN_MENU
 
+async def db_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """يعرض للمدير أكثر الاستعلامات استهلاكاً للوقت (الأمر /dbstats، يحتاج DB_PROFILE=1)."""
+    if not is_admin(update.effective_user.id):
+        return
+    if not query_profiler.PROFILE_ENABLED:
+        await update.message.reply_text("ℹ️ تحليل الاستعلامات غير مفعّل. فعّله بمتغير البيئة DB_PROFILE=1.")
+        return
+    
+    stats = query_profiler.get_query_stats()
+    if not stats:
+        await update.message.reply_text("ℹ️ لا توجد استعلامات مسجلة بعد.")
+        return
+    
+    lines = ["📈 أكثر الاستعلامات استهلاكاً للوقت:"]
+    for item in stats:
+        lines.append(
+            f"\n• {item.calls} مرة | المجموع {item.total_seconds * 1000:.0f}ms | "
+            f"المعدل {item.mean_seconds * 1000:.1f}ms | الأقصى {item.max_seconds * 1000:.1f}ms | "
+            f"بطيء {item.slow_calls} | صفوف {item.rows}\n{item.query[:300]}"
+        )
+    await update.message.reply_text("\n".join(lines)[:4000])
+
+# ----------------------------------------------------------------------
+# إشعارات المجهزين
+# ----------------------------------------------------------------------
+
+# تنبيه المجهزين المربوطين بمحل تلقائياً عند تعديله
+AUTO_NOTIFY_AGENTS = os.environ.get('AUTO_NOTIFY_AGENTS', '1') == '1'
+
+async def notify_agents(bot, chat_ids: list, text: str, report_chat_id: int = None) -> None:
+    """ترسل الرسالة للمجهزين بالخلفية، وتشيل الحسابات اللي حظرت البوت، وترسل التقرير للمدير إذا انطى report_chat_id."""
+    report = await send_bulk(bot, chat_ids, text)
+    if report.unreachable:
+        await clear_agent_telegram_ids(report.unreachable)
+    logger.info(f"Agent notification: {report.delivered}/{report.total} delivered, {report.failed} failed")
+    if report_chat_id is not None:
+        await bot.send_message(chat_id=report_chat_id, text=report.summary_text())
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """يرسل رسالة المدير لكل المجهزين اللي سجلوا دخول (الأمر /broadcast النص)."""
+    if not is_admin(update.effective_user.id):
+        return
+    # النص ممكن يبدي بسطر جديد بعد الأمر، فنقسم على أي فراغ
+    parts = update.message.text.split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ''
+    if not text:
+        await update.message.reply_text("ℹ️ الاستخدام: /broadcast نص الرسالة")
+        return
+    
+    chat_ids = await get_agent_telegram_ids()
+    if chat_ids is None:
+        await update.message.reply_text("❌ فشل جلب المجهزين من قاعدة البيانات.")
+        return
+    if not chat_ids:
+        await update.message.reply_text("ℹ️ لا يوجد مجهزين سجلوا دخول للبوت بعد.")
+        return
+    
+    await update.message.reply_text(f"⏳ جاري الإرسال إلى {len(chat_ids)} مجهز...")
+    # الإرسال بالخلفية حتى المعالج ما يبقى ماسك دور المدير طول مدة الإرسال
+    context.application.create_task(
+        notify_agents(context.bot, chat_ids, f"📢 {text}", report_chat_id=update.effective_chat.id),
+        update=update
+    )
+
 # ----------------------------------------------------------------------
 # دوال إدارة المدير (ADMIN)
 # ----------------------------------------------------------------------
@@ -126,10 +275,7 @@ async def show_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, is
     
     if update.callback_query and not is_command:
         await update.callback_query.answer()
-        try:
-             await update.callback_query.edit_message_text(text=text, reply_markup=reply_markup)
-        except Exception:
-             await update.callback_query.message.reply_text(text=text, reply_markup=reply_markup)
+        await edit_message(update.callback_query.message, text, reply_markup)
              
     elif update.message or is_command:
         await update.effective_message.reply_text(text=text, reply_markup=reply_markup)
@@ -148,10 +294,12 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
     elif data == "add_shop":
         # بدء عملية إضافة محل
-        await query.edit_message_text(
+        await edit_message(query.message,
             "📝 أرسل اسم المحل ورابطه في سطرين منفصلين:\n"
             "الاسم\n"
-            "الرابط (URL)",
+            "الرابط (URL)\n\n"
+            "📦 للإضافة بالجملة: أرسل عدة محلات برسالة وحدة (كل محل سطرين)، "
+            "أو إرفع ملف CSV/TSV فيه عمودين: الاسم، الرابط.",
             # ✅ زر "إنهاء والعودة" الجديد
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ إنهاء والعودة", callback_data="admin_menu")]])
         )
@@ -181,6 +329,12 @@ async def receive_shop_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
     keyboard = [[InlineKeyboardButton("✅ إنهاء والعودة", callback_data="admin_menu")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
+    # أكثر من محل بنفس الرسالة: إضافة بالجملة
+    if len([line for line in text.splitlines() if line.strip()]) > 2:
+        report = await run_db(import_shops, iter_message_rows(text))
+        await update.message.reply_text(report.summary_text(), reply_markup=reply_markup)
+        return ADD_SHOP_STATE
+    
     if len(parts) != 2:
         await update.message.reply_text(
             "❌ صيغة الإدخال خطأ. لازم تكون:\n"
@@ -193,7 +347,8 @@ async def receive_shop_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
     shop_name = parts[0].strip()
     shop_url = parts[1].strip()
 
-    if add_shop(shop_name, shop_url):
+    result = await add_shop(shop_name, shop_url)
+    if result == CREATED:
         # 💡 يبقى في نفس الحالة
         await update.message.reply_text(
             f"✅ تم إضافة محل: **{shop_name}** بنجاح.\n"
@@ -201,24 +356,57 @@ async def receive_shop_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
             reply_markup=reply_markup,
             parse_mode="Markdown"
         )
+    elif result == NAME_EXISTS:
+        await update.message.reply_text(
+            f"❌ فشل إضافة المحل. يوجد محل بإسم **{shop_name}** بالفعل.",
+            reply_markup=reply_markup,
+            parse_mode="Markdown"
+        )
     else:
         await update.message.reply_text(
-            "❌ فشل إضافة المحل. قد يكون الاسم مستخدماً بالفعل أو حدث خطأ في قاعدة البيانات.",
+            "❌ فشل إضافة المحل. حدث خطأ في قاعدة البيانات.",
             reply_markup=reply_markup
         )
 
     # البقاء في نفس الحالة (ADD_SHOP_STATE) لإضافة محل جديد
     return ADD_SHOP_STATE
 
-async def show_and_search_shops(update: Update, context: ContextTypes.DEFAULT_TYPE, search_term: str = None) -> int:
-    """تعرض قائمة المحلات وتسمح بالبحث، مع أزرار الإدارة (تعديل وحذف)."""
+async def receive_shop_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """يستقبل ملف CSV/TSV فيه المحلات (الاسم، الرابط) ويضيفها بالجملة."""
+    keyboard = [[InlineKeyboardButton("✅ إنهاء والعودة", callback_data="admin_menu")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    document = update.message.document
+    file_name = (document.file_name or "").lower()
+    if not file_name.endswith(('.csv', '.tsv', '.txt')):
+        await update.message.reply_text(
+            "❌ نوع الملف غير مدعوم. أرسل ملف CSV أو TSV فيه عمودين: الاسم، الرابط.",
+            reply_markup=reply_markup
+        )
+        return ADD_SHOP_STATE
+    
+    telegram_file = await document.get_file()
+    data = await telegram_file.download_as_bytearray()
+    
+    report = await run_db(import_shops, iter_document_rows(bytes(data)))
+    await update.message.reply_text(report.summary_text(), reply_markup=reply_markup)
+    return ADD_SHOP_STATE
+
+async def render_admin_shops(search_term: str = None, after: tuple = None, before: tuple = None):
+    """تبني نص وأزرار ومؤشرات صفحات شاشة المحلات للمدير (تُخزن بكاش الشاشات)."""
     
     if search_term:
-        shops = get_shops_by_search(search_term) 
+        # نتائج البحث مرتبة حسب الأقرب ومحدودة العدد، فما تحتاج تقسيم لصفحات
+        shops = await get_shops_by_search(search_term)
+        has_prev = has_next = False
     else:
-        shops = get_all_shops()
+        shops, has_prev, has_next = await get_shops_page(after, before)
+        if not shops and (after or before):
+            # ما بقت محلات بعد المؤشر (انحذفت): نرجع للصفحة الأولى
+            shops, has_prev, has_next = await get_shops_page()
     
     keyboard = []
+    cursors = {}
     
     if shops:
         if search_term:
@@ -227,9 +415,7 @@ async def show_and_search_shops(update: Update, context: ContextTypes.DEFAULT_TY
             text = "📊 **جميع المحلات:**\n يمكنك كتابة اسم المحل للبحث السريع."
             
         for shop in shops:
-            shop_url = shop['url']
-            if not shop_url.lower().startswith(('http://', 'https://')):
-                 shop_url = "https://" + shop_url 
+            shop_url = normalize_shop_url(shop['url'])
             
             # زر المحل (بدون رمز رابط)
             url_button = InlineKeyboardButton(text=f" {shop['name']}", url=shop_url)
@@ -240,6 +426,10 @@ async def show_and_search_shops(update: Update, context: ContextTypes.DEFAULT_TY
             keyboard.append([url_button])
             keyboard.append([edit_button, delete_button]) 
             keyboard.append([InlineKeyboardButton("------", callback_data="ignore")])
+        
+        nav_row, cursors = build_page_nav("shops_pg", shops, has_prev, has_next)
+        if nav_row:
+            keyboard.append(nav_row)
     
     else:
         if search_term:
@@ -253,21 +443,22 @@ async def show_and_search_shops(update: Update, context: ContextTypes.DEFAULT_TY
     keyboard.append([InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="admin_menu")])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    return text, reply_markup, cursors
+
+async def show_and_search_shops(update: Update, context: ContextTypes.DEFAULT_TYPE, search_term: str = None,
+                                after: tuple = None, before: tuple = None) -> int:
+    """تعرض صفحة من قائمة المحلات وتسمح بالبحث، مع أزرار الإدارة (تعديل وحذف) والتنقل بين الصفحات."""
+    
+    text, reply_markup, cursors = await get_or_render(
+        ("admin_shops", search_term, after, before),
+        lambda: render_admin_shops(search_term, after, before)
+    )
+    remember_page_cursors(context.user_data, cursors)
 
     if update.callback_query:
         await update.callback_query.answer()
-        try:
-            await update.callback_query.edit_message_text(
-                text=text, 
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
-            )
-        except:
-             await update.callback_query.message.reply_text(
-                text=text, 
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
-            )
+        await edit_message(update.callback_query.message, text, reply_markup, parse_mode="Markdown")
     elif update.message:
         await update.message.reply_text(
             text=text,
@@ -277,11 +468,17 @@ async def show_and_search_shops(update: Update, context: ContextTypes.DEFAULT_TY
     
     return SHOW_SHOPS_ADMIN
 
+@throttled('search')
 async def admin_shop_search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يستقبل نص البحث من المدير (في حالة SHOW_SHOPS_ADMIN) ويعرض النتائج."""
     search_term = update.message.text.strip()
     return await show_and_search_shops(update, context, search_term)
 
+async def shops_page_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """ينقل المدير للصفحة التالية/السابقة من قائمة المحلات."""
+    after, before = page_cursor(context.user_data, update.callback_query.data)
+    return await show_and_search_shops(update, context, None, after, before)
+
 async def confirm_shop_deletion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """ينفذ حذف المحل فعلياً."""
     query = update.callback_query
@@ -292,11 +489,17 @@ async def confirm_shop_deletion(update: Update, context: ContextTypes.DEFAULT_TY
     except ValueError:
         return await show_admin_menu(update, context)
 
-    if delete_shop(shop_id):
+    result = await delete_shop(shop_id)
+    if result == DELETED:
         await query.message.reply_text(
             f"✅ تم حذف المحل بنجاح!", 
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 العودة لقائمة المحلات", callback_data="show_shops_list")]])
         )
+    elif result == NOT_FOUND:
+        await query.message.reply_text(
+            "ℹ️ المحل محذوف مسبقاً.", 
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 العودة لقائمة المحلات", callback_data="show_shops_list")]])
+        )
     else:
         await query.message.reply_text(
             "❌ حدث خطأ أثناء حذف المحل.", 
@@ -319,7 +522,7 @@ async def prompt_edit_shop_details(update: Update, context: ContextTypes.DEFAULT
     keyboard = [[InlineKeyboardButton("🔙 إلغاء والعودة", callback_data="show_shops_list")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.edit_message_text(
+    await edit_message(query.message,
         f"📝 لإجراء التعديل على المحل رقم {shop_id}:\n"
         "أرسل **الاسم الجديد** و **الرابط الجديد** في سطرين منفصلين:\n"
         "الاسم الجديد\n"
@@ -348,10 +551,23 @@ async def receive_updated_shop_data(update: Update, context: ContextTypes.DEFAUL
     new_name = parts[0].strip()
     new_url = parts[1].strip()
 
-    if update_shop_details(shop_id, new_name, new_url):
+    result = await update_shop_details(shop_id, new_name, new_url)
+    if result == UPDATED:
         await update.message.reply_text(f"✅ تم تحديث تفاصيل المحل رقم {shop_id} بنجاح!")
+        if AUTO_NOTIFY_AGENTS:
+            chat_ids = await get_agent_telegram_ids([shop_id])
+            if chat_ids:
+                context.application.create_task(
+                    notify_agents(context.bot, chat_ids, f"🔄 تم تحديث المحل: {new_name}\n{normalize_shop_url(new_url)}"),
+                    update=update
+                )
+    elif result == NAME_EXISTS:
+        await update.message.reply_text(f"❌ فشل التحديث. يوجد محل آخر بإسم '{new_name}'. أرسل إسماً مختلفاً:")
+        return EDIT_SHOP_STATE
+    elif result == NOT_FOUND:
+        await update.message.reply_text(f"❌ المحل رقم {shop_id} لم يعد موجوداً.")
     else:
-        await update.message.reply_text("❌ فشل تحديث التفاصيل. قد يكون الاسم مستخدماً أو حدث خطأ.")
+        await update.message.reply_text("❌ فشل تحديث التفاصيل. حدث خطأ في قاعدة البيانات.")
 
     return await show_and_search_shops(update, context) 
 
@@ -360,17 +576,10 @@ async def receive_updated_shop_data(update: Update, context: ContextTypes.DEFAUL
 # دوال إدارة المجهزين (Agents Management) - تم تبسيطها بالكامل
 # ----------------------------------------------------------------------
 
-async def show_and_manage_agents(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """تعرض قائمة المجهزين مع أزرار الإدارة (تعديل، حذف، تخصيص) بشكل مصغّر."""
+async def render_agents_list():
+    """تبني نص وأزرار قائمة المجهزين (تُخزن بكاش الشاشات)."""
     
-    if update.callback_query:
-        query = update.callback_query
-        await query.answer()
-        message = query.message
-    else:
-        message = update.message
-        
-    agents = get_all_agents()
+    agents = await get_all_agents()
     
     keyboard = []
     
@@ -401,12 +610,23 @@ async def show_and_manage_agents(update: Update, context: ContextTypes.DEFAULT_T
     # زر العودة 
     keyboard.append([InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="admin_menu")])
     reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    return text, reply_markup
 
+async def show_and_manage_agents(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """تعرض قائمة المجهزين مع أزرار الإدارة (تعديل، حذف، تخصيص) بشكل مصغّر."""
+    
     if update.callback_query:
-        try:
-            await message.edit_text(text=text, reply_markup=reply_markup, parse_mode="Markdown")
-        except:
-             await message.reply_text(text=text, reply_markup=reply_markup, parse_mode="Markdown")
+        query = update.callback_query
+        await query.answer()
+        message = query.message
+    else:
+        message = update.message
+        
+    text, reply_markup = await get_or_render(("agents",), render_agents_list)
+
+    if update.callback_query:
+        await edit_message(message, text, reply_markup, parse_mode="Markdown")
     elif update.message:
          await message.reply_text(text=text, reply_markup=reply_markup, parse_mode="Markdown")
          
@@ -419,7 +639,7 @@ async def manage_agents_handler(update: Update, context: ContextTypes.DEFAULT_TY
     data = query.data
     
     if data == "add_new_agent":
-        await query.edit_message_text(
+        await edit_message(query.message,
             "📝 أرسل اسم المجهز والرمز السري في سطرين منفصلين:\n"
             "الاسم\n"
             "الرمز السري (Code)",
@@ -450,10 +670,14 @@ async def receive_agent_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
     agent_name = parts[0].strip()
     secret_code = parts[1].strip()
 
-    if add_agent(agent_name, secret_code):
+    result = await add_agent(agent_name, secret_code)
+    if result == CREATED:
         await update.message.reply_text(f"✅ تم إضافة مجهز: {agent_name}")
+    elif result == CODE_EXISTS:
+        await update.message.reply_text("❌ فشل إضافة المجهز. الرمز السري مستخدم بالفعل لمجهز آخر، أرسل الاسم ورمز مختلف:")
+        return ADD_AGENT_STATE
     else:
-        await update.message.reply_text("❌ فشل إضافة المجهز. الرمز السري قد يكون مستخدماً أو حدث خطأ في قاعدة البيانات.")
+        await update.message.reply_text("❌ فشل إضافة المجهز. حدث خطأ في قاعدة البيانات.")
 
     # نعود إلى قائمة عرض/إدارة المجهزين
     return await show_and_manage_agents(update, context)
@@ -468,10 +692,13 @@ async def confirm_agent_deletion(update: Update, context: ContextTypes.DEFAULT_T
     except ValueError:
         return await show_and_manage_agents(update, context)
 
-    agent_name = get_agent_name_by_id(agent_id)
+    agent_name = await get_agent_name_by_id(agent_id)
     
-    if delete_agent(agent_id):
+    result = await delete_agent(agent_id)
+    if result == DELETED:
         await query.message.reply_text(f"✅ تم حذف المجهز **{agent_name}** بنجاح!")
+    elif result == NOT_FOUND:
+        await query.message.reply_text("ℹ️ المجهز محذوف مسبقاً.")
     else:
         await query.message.reply_text("❌ حدث خطأ أثناء حذف المجهز.")
 
@@ -492,7 +719,7 @@ async def edit_agent_details_menu(update: Update, context: ContextTypes.DEFAULT_
     keyboard = [[InlineKeyboardButton("🔙 إلغاء والعودة", callback_data="manage_agents_back")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.edit_message_text(
+    await edit_message(query.message,
         f"📝 لإجراء التعديل على المجهز رقم {agent_id}:\n"
         "أرسل **الاسم الجديد** و **الرمز السري الجديد** في سطرين منفصلين:\n"
         "الاسم الجديد\n"
@@ -521,19 +748,66 @@ async def receive_updated_agent_data(update: Update, context: ContextTypes.DEFAU
     new_name = parts[0].strip()
     new_code = parts[1].strip()
 
-    result = update_agent_details(agent_id, new_name, new_code)
+    result = await update_agent_details(agent_id, new_name, new_code)
     
-    if result is True:
+    if result == UPDATED:
         await update.message.reply_text(f"✅ تم تحديث تفاصيل المجهز رقم {agent_id} بنجاح!")
-    elif result == "CODE_EXISTS":
+    elif result == CODE_EXISTS:
         await update.message.reply_text("❌ فشل التحديث. الرمز السري الجديد مستخدم بالفعل لمجهز آخر.")
         return EDIT_AGENT_DETAILS
+    elif result == NOT_FOUND:
+        await update.message.reply_text(f"❌ المجهز رقم {agent_id} لم يعد موجوداً.")
     else:
         await update.message.reply_text("❌ فشل تحديث التفاصيل. حدث خطأ في قاعدة البيانات.")
 
     return await show_and_manage_agents(update, context)
 
 
+async def render_assignment(agent_id: int, assigned_shops: set, after: tuple = None, before: tuple = None):
+    """تبني نص وأزرار ومؤشرات صفحات شاشة تخصيص المحلات لمجهز (ما تنخزن بكاش الشاشات لأنها تتغير مع كل ضغطة)."""
+    # اسم المجهز وصفحة المحلات يجون من الكاش غالباً
+    agent_name, (page_shops, has_prev, has_next) = await asyncio.gather(
+        get_agent_name_by_id(agent_id),
+        get_shops_page(after, before),
+    )
+    if not page_shops and (after or before):
+        page_shops, has_prev, has_next = await get_shops_page()
+    
+    text = f"🔗 **تخصيص المحلات للمجهز {agent_name}:**\n"
+    text += "إضغط على المحل للربط (✅) أو إلغاء الربط (❌).\n"
+    text += "أو أكتب جزء من اسم المحل لربط/إلغاء ربط كل المحلات المطابقة."
+    
+    # أزرار العمليات بالجملة
+    keyboard = [
+        [
+            InlineKeyboardButton("✅ ربط الكل", callback_data="assign_bulk_all"),
+            InlineKeyboardButton("❌ إلغاء الكل", callback_data="assign_bulk_none"),
+        ],
+        [InlineKeyboardButton("📋 نسخ من مجهز آخر", callback_data="assign_bulk_copy")],
+    ]
+    cursors = {}
+    if page_shops:
+        for shop in page_shops:
+            status = "✅" if shop['id'] in assigned_shops else "❌"
+            
+            button = InlineKeyboardButton(
+                text=f"{status} {shop['name']}", 
+                callback_data=f"toggle_shop_{shop['id']}" 
+            )
+            keyboard.append([button])
+        
+        nav_row, cursors = build_page_nav("assign_pg", page_shops, has_prev, has_next)
+        if nav_row:
+            keyboard.append(nav_row)
+    else:
+        text = "❌ لا توجد محلات مُضافة لتخصيصها."
+
+    # زر العودة يعود إلى قائمة إدارة المجهزين المبسّطة
+    keyboard.append([InlineKeyboardButton("🔙 العودة", callback_data="manage_agents_back")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    return text, reply_markup, cursors
+
 async def list_shops_to_assign(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يعرض قائمة المحلات لإضافة أو إزالة الربط من مجهز محدد (بعد النقر على زر 🔗🏬)."""
     query = update.callback_query
@@ -543,45 +817,41 @@ async def list_shops_to_assign(update: Update, context: ContextTypes.DEFAULT_TYP
         try:
             agent_id = int(query.data.split('_')[-1])
             context.user_data['selected_agent_id'] = agent_id
+            context.user_data['assign_page'] = (None, None)
+            # نحمّل المحلات المربوطة مرة وحدة عند فتح الشاشة، وبعدها تتحدث بالذاكرة مع كل ضغطة
+            context.user_data['assigned_shop_ids'] = set(await get_assigned_shop_ids(agent_id))
         except ValueError:
             return await show_and_manage_agents(update, context)
     else:
         agent_id = context.user_data.get('selected_agent_id')
         if not agent_id:
             return await show_and_manage_agents(update, context)
-            
-    agent_name = get_agent_name_by_id(agent_id)
-    all_shops = get_all_shops()
-    assigned_shops = get_assigned_shop_ids(agent_id)
+        if query.data.startswith('assign_pg_'):
+            context.user_data['assign_page'] = page_cursor(context.user_data, query.data)
+        if 'assigned_shop_ids' not in context.user_data:
+            context.user_data['assigned_shop_ids'] = set(await get_assigned_shop_ids(agent_id))
     
-    text = f"🔗 **تخصيص المحلات للمجهز {agent_name}:**\n"
-    text += "إضغط على المحل للربط (✅) أو إلغاء الربط (❌)."
-    
-    keyboard = []
-    if all_shops:
-        for shop in all_shops:
-            is_assigned = shop['id'] in assigned_shops
-            status = "✅" if is_assigned else "❌"
-            
-            button = InlineKeyboardButton(
-                text=f"{status} {shop['name']}", 
-                callback_data=f"toggle_shop_{shop['id']}" 
-            )
-            keyboard.append([button])
-    else:
-        text = "❌ لا توجد محلات مُضافة لتخصيصها."
+    await refresh_assignment_screen(query.message, context.user_data)
+    return SELECT_SHOPS
 
-    # زر العودة يعود إلى قائمة إدارة المجهزين المبسّطة
-    keyboard.append([InlineKeyboardButton("🔙 العودة", callback_data="manage_agents_back")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+async def refresh_assignment_screen(message, user_data: dict) -> None:
+    """تعيد عرض شاشة التخصيص حسب الحالة الحالية بـ user_data (المجهز، الصفحة، المحلات المربوطة)."""
+    agent_id = user_data.get('selected_agent_id')
+    if not agent_id or 'assigned_shop_ids' not in user_data:
+        return
+    # نسخة ثابتة حتى الضغطات اللي تصير أثناء البناء ما تغير الشاشة بنصها
+    assigned_shops = frozenset(user_data['assigned_shop_ids'])
+    # الصفحة الحالية تبقى محفوظة حتى يرجع نفس العرض بعد الضغط على محل
+    after, before = user_data.get('assign_page', (None, None))
+    # ما نخزن هالشاشة بـ render_cache: كل ضغطة تغير المحلات المربوطة فالمفتاح ما يتكرر
+    text, reply_markup, cursors = await render_assignment(agent_id, assigned_shops, after, before)
+    remember_page_cursors(user_data, cursors)
 
-    await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode="Markdown")
-    return SELECT_SHOPS
+    await edit_message(message, text, reply_markup, parse_mode="Markdown")
 
 async def toggle_shop_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """ربط أو إلغاء ربط محل بمجهز عند النقر على علامة صح/خطأ."""
     query = update.callback_query
-    await query.answer()
     
     try:
         shop_id = int(query.data.split('_')[-1])
@@ -595,14 +865,109 @@ async def toggle_shop_selection(update: Update, context: ContextTypes.DEFAULT_TY
         logger.error(f"Error extracting IDs in toggle_shop_selection: {e}")
         return await show_and_manage_agents(update, context)
 
-    assigned_shops = get_assigned_shop_ids(agent_id)
-    is_assigned = shop_id in assigned_shops
+    # استعلام واحد يقلب الربط ويرجع الحالة الجديدة
+    is_assigned = await toggle_agent_shop(agent_id, shop_id)
     
-    if toggle_agent_shop_assignment(agent_id, shop_id, not is_assigned):
-        return await list_shops_to_assign(update, context)
-    else:
+    if is_assigned is None:
         await query.answer("❌ فشل تحديث الربط في قاعدة البيانات.")
         return SELECT_SHOPS 
+    await query.answer()
+    
+    # نحدث المجموعة بالذاكرة حتى إعادة العرض ما تحتاج استعلامات إضافية
+    assigned_shops = context.user_data.get('assigned_shop_ids')
+    if assigned_shops is None:
+        context.user_data['assigned_shop_ids'] = set(await get_assigned_shop_ids(agent_id))
+    elif is_assigned:
+        assigned_shops.add(shop_id)
+    else:
+        assigned_shops.discard(shop_id)
+
+    # الضغطات السريعة على نفس الرسالة تنجمع بإعادة عرض وحدة تعكس آخر حالة
+    user_data = context.user_data
+    schedule_render(
+        context.application, query.message,
+        lambda: refresh_assignment_screen(query.message, user_data),
+        update=update
+    )
+    return SELECT_SHOPS
+
+async def assign_search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """يستقبل نص البحث في شاشة التخصيص ويعرض أزرار ربط/إلغاء ربط كل المحلات المطابقة."""
+    search_term = update.message.text.strip()
+    context.user_data['assign_search'] = search_term
+    
+    keyboard = [
+        [
+            InlineKeyboardButton("✅ ربط كل المطابق", callback_data="assign_bulk_search_add"),
+            InlineKeyboardButton("❌ إلغاء ربط كل المطابق", callback_data="assign_bulk_search_del"),
+        ],
+        [InlineKeyboardButton("🔙 العودة للتخصيص", callback_data="assign_bulk_cancel")],
+    ]
+    await update.message.reply_text(
+        f"🔎 المحلات اللي اسمها يحتوي '{search_term}':",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return SELECT_SHOPS
+
+async def choose_copy_source(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """يعرض قائمة المجهزين لاختيار المجهز اللي تنسخ محلاته للمجهز الحالي."""
+    query = update.callback_query
+    await query.answer()
+    agent_id = context.user_data.get('selected_agent_id')
+    
+    agents = await get_all_agents()
+    keyboard = [
+        [InlineKeyboardButton(f"🧔🏻‍♂ {agent['name']}", callback_data=f"assign_copy_{agent['id']}")]
+        for agent in (agents or []) if agent['id'] != agent_id
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 العودة للتخصيص", callback_data="assign_bulk_cancel")])
+    
+    await edit_message(query.message,
+        "📋 إختار المجهز اللي تريد تنسخ محلاته:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return SELECT_SHOPS
+
+async def bulk_assignment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """ينفذ عملية ربط/إلغاء ربط بالجملة بأمر واحد ثم يعيد عرض شاشة التخصيص مرة وحدة."""
+    query = update.callback_query
+    data = query.data
+    agent_id = context.user_data.get('selected_agent_id')
+    if not agent_id:
+        await query.answer()
+        return await show_and_manage_agents(update, context)
+    
+    assign = True
+    if data == "assign_bulk_all":
+        changed = await assign_all_shops(agent_id)
+    elif data == "assign_bulk_none":
+        changed = await unassign_all_shops(agent_id)
+        assign = False
+    elif data in ("assign_bulk_search_add", "assign_bulk_search_del"):
+        search_term = context.user_data.get('assign_search')
+        if not search_term:
+            return await list_shops_to_assign(update, context)
+        assign = data == "assign_bulk_search_add"
+        changed = await assign_shops_by_search(agent_id, search_term, assign)
+    elif data.startswith("assign_copy_"):
+        changed = await copy_agent_assignments(int(data.split('_')[-1]), agent_id)
+    else:
+        # assign_bulk_cancel: رجوع بدون تغيير
+        return await list_shops_to_assign(update, context)
+    
+    if changed is None:
+        await query.answer("❌ فشل تحديث الربط في قاعدة البيانات.")
+        return SELECT_SHOPS
+    
+    # الأمر يرجع المحلات اللي تغيرت فقط، فنحدث المجموعة بالذاكرة بدون استعلام إضافي
+    assigned_shops = context.user_data.get('assigned_shop_ids')
+    if assigned_shops is not None:
+        if assign:
+            assigned_shops.update(changed)
+        else:
+            assigned_shops.difference_update(changed)
+    
+    return await list_shops_to_assign(update, context)
 
 # ----------------------------------------------------------------------
 # دوال المجهز (Agent)
@@ -612,21 +977,25 @@ async def agent_login_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """يطلب من المجهز إدخال الرمز السري."""
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text(
+    await edit_message(query.message,
         "🔑 **أدخل رقمك السري الآن**:",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 العودة", callback_data="start")]])
     )
     return AGENT_LOGIN
 
+@throttled('login')
 async def agent_login_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يستقبل الرمز السري ويتحقق منه."""
     secret_code = update.message.text.strip()
-    agent = check_agent_code(secret_code)
+    agent = await check_agent_code(secret_code)
     
     if agent:
         context.user_data['is_agent'] = True
         context.user_data['agent_id'] = agent['id']
         context.user_data['agent_name'] = agent['name']
+        # نربط حساب تيليجرام بالمجهز حتى توصله الإشعارات ويدخل تلقائياً المرة الجاية
+        if agent['telegram_id'] != update.effective_user.id:
+            await set_agent_telegram_id(agent['id'], update.effective_user.id, agent['name'])
         
         await update.message.reply_text(f"👋🏼 أهلاً بك يا مجهز {agent['name']}!")
         return await show_agent_menu(update, context, is_login=True)
@@ -648,7 +1017,7 @@ async def show_agent_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, is
     
     if update.callback_query and not is_login:
         await update.callback_query.answer()
-        await update.callback_query.edit_message_text(text=text, reply_markup=reply_markup)
+        await edit_message(update.callback_query.message, text, reply_markup)
     elif update.message or is_login:
         await update.effective_message.reply_text(text=text, reply_markup=reply_markup)
         
@@ -665,15 +1034,20 @@ async def agent_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
     return AGENT_MENU
 
-async def show_agent_shops(update: Update, context: ContextTypes.DEFAULT_TYPE, search_term: str = None) -> int:
-    """تعرض المحلات المخصصة للمجهز وتسمح بالبحث."""
+async def show_agent_shops(update: Update, context: ContextTypes.DEFAULT_TYPE, search_term: str = None,
+                           after: tuple = None, before: tuple = None) -> int:
+    """تعرض صفحة من المحلات المخصصة للمجهز وتسمح بالبحث والتنقل بين الصفحات."""
     
     agent_id = context.user_data.get('agent_id')
     
     if search_term:
-        shops = get_agent_shops_by_search(agent_id, search_term)
+        # نتائج البحث مرتبة حسب الأقرب ومحدودة العدد، فما تحتاج تقسيم لصفحات
+        shops = await get_agent_shops_by_search(agent_id, search_term)
+        has_prev = has_next = False
     else:
-        shops = get_agent_shops_by_search(agent_id, "") 
+        shops, has_prev, has_next = await get_agent_shops_page(agent_id, after, before)
+        if not shops and (after or before):
+            shops, has_prev, has_next = await get_agent_shops_page(agent_id)
     
     keyboard = []
     
@@ -684,13 +1058,16 @@ async def show_agent_shops(update: Update, context: ContextTypes.DEFAULT_TYPE, s
             text = "📊 **محلاتك المخصصة:**\n يمكنك كتابة اسم المحل للبحث السريع."
             
         for shop in shops:
-            shop_url = shop['url']
-            if not shop_url.lower().startswith(('http://', 'https://')):
-                 shop_url = "https://" + shop_url 
+            shop_url = normalize_shop_url(shop['url'])
             
             url_button = InlineKeyboardButton(text=f" {shop['name']}", url=shop_url)
             keyboard.append([url_button])
             keyboard.append([InlineKeyboardButton("---", callback_data="ignore")])
+        
+        nav_row, cursors = build_page_nav("ashops_pg", shops, has_prev, has_next)
+        remember_page_cursors(context.user_data, cursors)
+        if nav_row:
+            keyboard.append(nav_row)
     
     else:
         if search_term:
@@ -704,11 +1081,7 @@ async def show_agent_shops(update: Update, context: ContextTypes.DEFAULT_TYPE, s
 
     if update.callback_query:
         await update.callback_query.answer()
-        await update.callback_query.edit_message_text(
-            text=text, 
-            reply_markup=reply_markup,
-            parse_mode="Markdown"
-        )
+        await edit_message(update.callback_query.message, text, reply_markup, parse_mode="Markdown")
     elif update.message:
         await update.message.reply_text(
             text=text,
@@ -718,29 +1091,129 @@ async def show_agent_shops(update: Update, context: ContextTypes.DEFAULT_TYPE, s
     
     return AGENT_MENU
 
+@throttled('search')
 async def agent_shop_search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يستقبل نص البحث من المجهز ويعرض النتائج."""
     search_term = update.message.text.strip()
     return await show_agent_shops(update, context, search_term)
 
+async def agent_shops_page_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """ينقل المجهز للصفحة التالية/السابقة من محلاته."""
+    after, before = page_cursor(context.user_data, update.callback_query.data)
+    return await show_agent_shops(update, context, None, after, before)
+
 
 # ----------------------------------------------------------------------
-# الدوال الرئيسية (Main)
+# البحث السريع من أي محادثة (Inline Mode)
 # ----------------------------------------------------------------------
 
-def main() -> None:
-    """الدالة الرئيسية لتشغيل البوت."""
+# مدة احتفاظ تيليجرام بنتائج البحث لكل مستخدم (بالثواني)
+INLINE_CACHE_TIME = int(os.environ.get('INLINE_CACHE_TIME', '30'))
+
+async def inline_shop_lookup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """يرجع محلات المجهز المطابقة لما يكتبه بعد @اسم_البوت في أي محادثة."""
+    inline_query = update.inline_query
+    agent_id = context.user_data.get('agent_id')
     
-    BOT_TOKEN = os.environ.get("BOT_TOKEN")
-    if not BOT_TOKEN:
-        logger.error("🚫 BOT_TOKEN غير معرّف. لا يمكن تشغيل البوت.")
+    if not agent_id:
+        # المستخدم مو مسجل دخول كمجهز: زر ينقله للبوت لتسجيل الدخول
+        await inline_query.answer(
+            [],
+            cache_time=0,
+            is_personal=True,
+            button=InlineQueryResultsButton(text="🔑 سجل دخولك أولاً", start_parameter="login")
+        )
         return
+    
+    shops = await get_agent_shops_by_prefix(agent_id, inline_query.query.strip())
+    
+    results = []
+    for shop in shops:
+        shop_url = normalize_shop_url(shop['url'])
+        results.append(InlineQueryResultArticle(
+            id=str(shop['id']),
+            title=shop['name'],
+            description=shop_url,
+            url=shop_url,
+            input_message_content=InputTextMessageContent(f"{shop['name']}\n{shop_url}"),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"🔗 {shop['name']}", url=shop_url)]])
+        ))
+    
+    # النتائج خاصة بكل مجهز، فنخليها is_personal حتى تيليجرام ما يشاركها بين المستخدمين
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
 
-    setup_db()
 
-    application = Application.builder().token(BOT_TOKEN).build()
+# ----------------------------------------------------------------------
+# الدوال الرئيسية (Main)
+# ----------------------------------------------------------------------
+
+# أكبر عدد تحديثات تتعالج بنفس الوقت (لمستخدمين مختلفين)
+MAX_CONCURRENT_UPDATES = int(os.environ.get('MAX_CONCURRENT_UPDATES', '64'))
+# أكبر عدد تحديثات مقبولة (تشتغل أو تنتظر دورها حسب الأولوية)
+MAX_PENDING_UPDATES = int(os.environ.get('MAX_PENDING_UPDATES', '1024'))
+
+# أزرار التنقل (الصفحات والقوائم): ما تغير بيانات، فإذا قدمت أو وراها ضغطة تنقل أحدث على نفس الرسالة نتجاهلها.
+# الأزرار اللي تغير بيانات (toggle_shop_، assign_bulk_، delete_..._confirm_) لا تنضاف هنا
+NAVIGATION_CALLBACKS = re.compile(
+    r"^((shops|assign|ashops)_pg_[np]_\d+|show_shops_list|show_agent_shops|manage_agents|manage_agents_back"
+    r"|admin_menu|agent_menu_back)$"
+)
+
+def update_priority(update: object) -> int:
+    """أولوية التحديث بالمعالج (الأصغر أولاً): المجهزين وبحثهم قبل شاشات المدير."""
+    user = update.effective_user if isinstance(update, Update) else None
+    return 1 if user is not None and is_admin(user.id) else 0
+
+# منفذ صفحة المقاييس (Prometheus)، افتراضياً المنفذ اللي بعد منفذ الـ Webhook. القيمة 0 تعطلها
+# (تسمع على 127.0.0.1 إلا إذا تغير METRICS_HOST، وعندها حط METRICS_TOKEN، شوف metrics.py)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', int(os.environ.get('PORT', '8080')) + 1))
+
+_metrics_server = None
+
+async def post_init(application: Application) -> None:
+    """تشغل خادم المقاييس بعد تجهيز البوت."""
+    global _metrics_server
+    if METRICS_PORT:
+        _metrics_server = MetricsServer(METRICS_PORT)
+        await _metrics_server.start()
+
+async def post_shutdown(application: Application) -> None:
+    """توقف خادم المقاييس وتغلق خيوط واتصالات قاعدة البيانات عند إيقاف البوت."""
+    if _metrics_server is not None:
+        await _metrics_server.stop()
+    shutdown_db()
+
+def build_application(bot_token: str, request=None) -> Application:
+    """
+    تبني الـ Application وتسجل كل المعالجات.
+    request: طبقة اتصال بديلة بتيليجرام (تُستخدم في benchmark.py بدل الشبكة الحقيقية).
+    """
+    update_processor = PerUserUpdateProcessor(
+        MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES,
+        priority=update_priority, navigation=NAVIGATION_CALLBACKS,
+    )
+    builder = (
+        Application.builder()
+        .token(bot_token)
+        .concurrent_updates(update_processor)
+        .persistence(PostgresPersistence(shared=MULTI_REPLICA))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    else:
+        # نفس حجم الـ connection pool الافتراضي، مع قياس مدة كل طلب لتيليجرام
+        builder = builder.request(InstrumentedHTTPXRequest(connection_pool_size=256))
+    if TELEGRAM_RATE_LIMIT:
+        # حد عام وحد لكل محادثة مع إعادة المحاولة بعد RetryAfter
+        builder = builder.rate_limiter(TelegramRateLimiter())
+    application = builder.build()
     
     application.add_handler(CommandHandler("admin", admin_login_command))
+    application.add_handler(CommandHandler("dbstats", db_stats_command))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(InlineQueryHandler(inline_shop_lookup))
     
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start_command)],
@@ -765,6 +1238,7 @@ def main() -> None:
             ADD_SHOP_STATE: [
                 # يتم البقاء في نفس الحالة
                 MessageHandler(filters.TEXT & ~filters.COMMAND, receive_shop_data),
+                MessageHandler(filters.Document.ALL, receive_shop_document),
                 # عند الضغط على زر "إنهاء والعودة" يعود للقائمة الرئيسية
                 CallbackQueryHandler(admin_menu_handler, pattern=r"^admin_menu$"),
                 CommandHandler("start", start_command),
@@ -773,6 +1247,7 @@ def main() -> None:
             SHOW_SHOPS_ADMIN: [
                 CallbackQueryHandler(confirm_shop_deletion, pattern=r"^delete_shop_confirm_\d+$"),
                 CallbackQueryHandler(prompt_edit_shop_details, pattern=r"^edit_shop_select_\d+$"),
+                CallbackQueryHandler(shops_page_handler, pattern=r"^shops_pg_[np]_\d+$"),
                 # ✅ التصحيح: تم إضافة 'add_shop' لتمكين الزر من العمل في هذه القائمة
                 CallbackQueryHandler(admin_menu_handler, pattern=r"^(show_shops_list|admin_menu|add_shop)$"),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, admin_shop_search_handler),
@@ -814,12 +1289,17 @@ def main() -> None:
             SELECT_SHOPS: [
                 CallbackQueryHandler(toggle_shop_selection, pattern=r"^toggle_shop_\d+$"), 
                 CallbackQueryHandler(list_shops_to_assign, pattern=r"^assign_shops_\d+$"),
+                CallbackQueryHandler(list_shops_to_assign, pattern=r"^assign_pg_[np]_\d+$"),
+                CallbackQueryHandler(choose_copy_source, pattern=r"^assign_bulk_copy$"),
+                CallbackQueryHandler(bulk_assignment_handler, pattern=r"^(assign_bulk_(all|none|search_add|search_del|cancel)|assign_copy_\d+)$"),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, assign_search_handler),
                 CallbackQueryHandler(manage_agents_handler, pattern=r"^manage_agents_back$"),
                 CommandHandler("start", start_command),
             ],
             
             AGENT_MENU: [
                 CallbackQueryHandler(agent_menu_handler, pattern=r"^show_agent_shops$"),
+                CallbackQueryHandler(agent_shops_page_handler, pattern=r"^ashops_pg_[np]_\d+$"),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, agent_shop_search_handler),
                 CallbackQueryHandler(show_agent_menu, pattern=r"^agent_menu_back$"), 
                 CallbackQueryHandler(start_command, pattern=r"^start$"), 
@@ -828,9 +1308,36 @@ def main() -> None:
         },
         
         fallbacks=[CommandHandler("start", start_command)],
+        name="main_conversation",
+        persistent=True,
     )
 
     application.add_handler(conv_handler)
+    instrument_application_handlers(application)
+    if MULTI_REPLICA:
+        # حالة كل مستخدم تنقرأ وتنحفظ بالقاعدة حول كل تحديث، مع إيجار ومنع تكرار (replicas.py)
+        update_processor.coordinator = ReplicaCoordinator(application)
+    return application
+
+def main() -> None:
+    """الدالة الرئيسية لتشغيل البوت."""
+    
+    BOT_TOKEN = os.environ.get("BOT_TOKEN")
+    if not BOT_TOKEN:
+        logger.error("🚫 BOT_TOKEN غير معرّف. لا يمكن تشغيل البوت.")
+        return
+    if not SECRET_CODE_PEPPER:
+        logger.error("🚫 SECRET_CODE_PEPPER غير معرّف. لا يمكن تشغيل البوت بدون مفتاح تشفير الرموز السرية.")
+        return
+
+    setup_db()
+    # تحميل فهرس جلسات المجهزين حتى الدخول التلقائي ما يحتاج استعلامات
+    load_agent_sessions()
+    if MULTI_REPLICA:
+        # تعديلات النسخ الثانية تفرغ الكاش المحلي
+        start_change_listener()
+
+    application = build_application(BOT_TOKEN)
     
     PORT = int(os.environ.get('PORT', '8080')) 
     RAILWAY_URL = os.getenv('APP_PUBLIC_URL') 
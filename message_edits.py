@@ -0,0 +1,118 @@
+# message_edits.py
+"""
+طبقة تعديل الرسائل: تتذكر آخر محتوى انعرض بكل رسالة وتتجاهل التعديل إذا ما تغير شي
+(بدل ما تيليجرام يرجع "message is not modified" ونرسل رسالة جديدة)،
+وتجمع الضغطات السريعة على نفس الرسالة بإعادة عرض وحدة بعد EDIT_DEBOUNCE_MS.
+"""
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from contextvars import ContextVar
+from telegram import Message
+from telegram.error import BadRequest, TelegramError
+
+from database import MULTI_REPLICA
+
+logger = logging.getLogger(__name__)
+
+# بوضع النسخ المتعددة (MULTI_REPLICA) الرسالة ممكن تتعدل من نسخة ثانية:
+# ما نعتمد على ذاكرة هالنسخة ولا نأجل العرض لبعد التحديث
+EDIT_DEBOUNCE_MS = int(os.getenv('EDIT_DEBOUNCE_MS', '0' if MULTI_REPLICA else '300'))
+EDIT_MEMORY_MAX_ENTRIES = int(os.getenv('EDIT_MEMORY_MAX_ENTRIES', '4096'))
+
+_last_rendered = OrderedDict() # (chat_id, message_id) -> (text, parse_mode, reply_markup)
+_pending = {} # (chat_id, message_id) -> asyncio.Task لإعادة عرض مؤجلة
+_in_flight = set() # كل مهام إعادة العرض اللي ما خلصت (المؤجلة والفورية)
+_in_scheduled_render = ContextVar('in_scheduled_render', default=False)
+
+
+def message_key(message: Message) -> tuple:
+    return (message.chat_id, message.message_id)
+
+def _remember(message: Message, content: tuple) -> None:
+    key = message_key(message)
+    _last_rendered[key] = content
+    _last_rendered.move_to_end(key)
+    while len(_last_rendered) > EDIT_MEMORY_MAX_ENTRIES:
+        _last_rendered.popitem(last=False)
+
+def _is_unchanged(message: Message, content: tuple) -> bool:
+    known = None if MULTI_REPLICA else _last_rendered.get(message_key(message))
+    if known is not None:
+        return known == content
+    # رسالة ما نعرف شنو انعرض بيها (مثلاً بعد إعادة التشغيل): نقارن بالرسالة نفسها إذا النص بدون تنسيق
+    text, parse_mode, reply_markup = content
+    return parse_mode is None and message.text == text and message.reply_markup == reply_markup
+
+
+async def edit_message(message: Message, text: str, reply_markup=None, parse_mode: str = None) -> Message:
+    """
+    تعدل الرسالة للنص والأزرار الجديدة، إلا إذا نفس المحتوى المعروض حالياً.
+    إذا الرسالة ما تنعدل (قديمة أو محذوفة) ترسل رسالة جديدة بدلها.
+    """
+    if not _in_scheduled_render.get():
+        # تعديل مباشر (مثلاً الرجوع لشاشة ثانية) يلغي أي إعادة عرض مؤجلة حتى ما ترجع تغطي عليه
+        cancel_pending(message)
+
+    content = (text, parse_mode, reply_markup)
+    if _is_unchanged(message, content):
+        return message
+
+    try:
+        await message.edit_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        if 'not modified' not in str(e).lower():
+            return await reply_message(message, text, reply_markup, parse_mode)
+    except TelegramError as e:
+        logger.warning(f"Could not edit message {message_key(message)}: {e}")
+        return await reply_message(message, text, reply_markup, parse_mode)
+
+    _remember(message, content)
+    return message
+
+async def reply_message(message: Message, text: str, reply_markup=None, parse_mode: str = None) -> Message:
+    """ترسل رسالة جديدة وتتذكر محتواها حتى التعديلات الجاية عليها تستفيد من المقارنة."""
+    sent = await message.reply_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+    _remember(sent, (text, parse_mode, reply_markup))
+    return sent
+
+
+def schedule_render(application, message: Message, render, update=None) -> None:
+    """
+    تؤجل إعادة عرض الرسالة EDIT_DEBOUNCE_MS، وأي طلب جديد لنفس الرسالة خلال هالمدة يلغي القديم،
+    فسلسلة ضغطات سريعة تنتهي بتعديل واحد يعكس آخر حالة.
+    render: دالة async بدون معاملات تقرأ الحالة الحالية وتعدل الرسالة.
+    """
+    if EDIT_DEBOUNCE_MS <= 0:
+        _track(application.create_task(render(), update=update))
+        return
+
+    key = message_key(message)
+    cancel_pending(message)
+
+    async def run():
+        _in_scheduled_render.set(True)
+        await asyncio.sleep(EDIT_DEBOUNCE_MS / 1000)
+        # بعد انتهاء الانتظار ما نسمح بالإلغاء، الضغطة الجاية تجدول عرض جديد
+        if _pending.get(key) is task:
+            del _pending[key]
+        await render()
+
+    task = application.create_task(run(), update=update)
+    _pending[key] = task
+    _track(task)
+
+def _track(task) -> None:
+    _in_flight.add(task)
+    task.add_done_callback(_in_flight.discard)
+
+async def wait_for_renders() -> None:
+    """تنتظر لحد ما تخلص كل إعادات العرض المجدولة (benchmark.py يستخدمها حتى تنحسب كلفتها على الخطوة)."""
+    while _in_flight:
+        await asyncio.gather(*_in_flight, return_exceptions=True)
+
+def cancel_pending(message: Message) -> None:
+    task = _pending.pop(message_key(message), None)
+    if task is not None and not task.done():
+        task.cancel()
@@ -0,0 +1,264 @@
+# metrics.py
+"""
+عدادات ومدد تنفيذ (Histograms) للمعالجات واستعلامات قاعدة البيانات وطلبات تيليجرام،
+تنعرض بصيغة Prometheus النصية على مسار HTTP (افتراضياً /metrics على 127.0.0.1 والمنفذ PORT + 1).
+بدون مكتبات خارجية حتى ما نضيف اعتماديات جديدة.
+"""
+import os
+import time
+import hmac
+import asyncio
+import logging
+import threading
+import functools
+from telegram.ext import ConversationHandler
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+# افتراضياً المقاييس بس من نفس الجهاز. إذا تحتاج تفتحها (METRICS_HOST=0.0.0.0) حط METRICS_TOKEN،
+# والطلب لازم يرسل "Authorization: Bearer <token>"
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# حدود الـ buckets بالثواني
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(label_names, label_values, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Counter:
+    """عداد يزيد فقط، لكل مجموعة labels قيمة منفصلة."""
+
+    def __init__(self, name: str, documentation: str, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """توزيع المدد على buckets ثابتة (مع المجموع والعدد) لكل مجموعة labels."""
+
+    def __init__(self, name: str, documentation: str, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._values = {} # label_values -> [counts per bucket..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values) -> None:
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def time(self, *label_values):
+        """Context manager يقيس مدة الكود اللي بداخله."""
+        return _Timer(self, label_values)
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, entry in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, entry):
+                    labels = _format_labels(self.label_names, label_values, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.label_names, label_values, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {entry[-1]}")
+                labels = _format_labels(self.label_names, label_values)
+                lines.append(f"{self.name}_sum{labels} {entry[-2]}")
+                lines.append(f"{self.name}_count{labels} {entry[-1]}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+        return False
+
+
+# ------------------------------------------------------------------------------------------------
+# المقاييس المعرّفة
+# ------------------------------------------------------------------------------------------------
+
+HANDLER_SECONDS = Histogram("shopsbot_handler_seconds", "Time spent in each bot handler.", ["handler"])
+HANDLER_ERRORS = Counter("shopsbot_handler_errors_total", "Exceptions raised by each bot handler.", ["handler"])
+HANDLER_THROTTLED = Counter("shopsbot_handler_throttled_total", "Updates rejected by per-user throttling or the DB handler cap.", ["kind", "reason"])
+DB_FUNCTION_SECONDS = Histogram("shopsbot_db_function_seconds", "Time spent in each database.py function, including executor wait.", ["function"])
+DB_QUERY_SECONDS = Histogram("shopsbot_db_query_seconds", "Time spent executing SQL statements (execute_query and transaction()).")
+DB_QUERY_ERRORS = Counter("shopsbot_db_query_errors_total", "SQL statements that raised an error.")
+DB_READ_QUERIES = Counter("shopsbot_db_read_queries_total", "Read-only queries by the database that served them (replica or primary).", ["target"])
+DB_POOL_ACQUIRE_SECONDS = Histogram("shopsbot_db_pool_acquire_seconds", "Time spent waiting for a pooled database connection.")
+TELEGRAM_API_SECONDS = Histogram("shopsbot_telegram_api_seconds", "Time spent in Telegram Bot API requests.", ["method"])
+TELEGRAM_API_ERRORS = Counter("shopsbot_telegram_api_errors_total", "Telegram Bot API requests that failed.", ["method"])
+TELEGRAM_RATE_LIMIT_WAIT_SECONDS = Histogram("shopsbot_telegram_rate_limit_wait_seconds", "Time Bot API requests waited in the outbound rate limiter.", ["priority"])
+TELEGRAM_RETRY_AFTER = Counter("shopsbot_telegram_retry_after_total", "Bot API requests rejected with RetryAfter (flood control).", ["method"])
+RENDER_CACHE_REQUESTS = Counter("shopsbot_render_cache_requests_total", "Rendered screen cache lookups.", ["screen", "result"])
+UPDATE_LEASE_WAIT_SECONDS = Histogram("shopsbot_update_lease_wait_seconds", "Time spent claiming an update and its per-user lease in multi-replica mode.")
+UPDATES_DROPPED = Counter("shopsbot_updates_dropped_total", "Incoming updates skipped by the update processor (stale, superseded or duplicate).", ["reason"])
+
+REGISTRY = [
+    HANDLER_SECONDS, HANDLER_ERRORS, HANDLER_THROTTLED,
+    DB_FUNCTION_SECONDS, DB_QUERY_SECONDS, DB_QUERY_ERRORS, DB_POOL_ACQUIRE_SECONDS, DB_READ_QUERIES,
+    TELEGRAM_API_SECONDS, TELEGRAM_API_ERRORS, TELEGRAM_RATE_LIMIT_WAIT_SECONDS, TELEGRAM_RETRY_AFTER,
+    RENDER_CACHE_REQUESTS, UPDATES_DROPPED, UPDATE_LEASE_WAIT_SECONDS,
+]
+
+def render_metrics() -> str:
+    """كل المقاييس بصيغة Prometheus النصية."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+# ------------------------------------------------------------------------------------------------
+# ربط المقاييس بالمعالجات وطلبات تيليجرام
+# ------------------------------------------------------------------------------------------------
+
+def instrument_handler(callback):
+    """تغلف معالج async حتى تسجل مدته وأخطاءه باسم الدالة."""
+    if getattr(callback, '_metrics_instrumented', False):
+        return callback
+    name = getattr(callback, '__name__', repr(callback))
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+    wrapper._metrics_instrumented = True
+    return wrapper
+
+def instrument_application_handlers(application) -> None:
+    """تغلف كل المعالجات المسجلة بالـ Application (ومن ضمنها معالجات الـ ConversationHandler)."""
+    def instrument(handlers):
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                instrument(handler.entry_points)
+                for state_handlers in handler.states.values():
+                    instrument(state_handlers)
+                instrument(handler.fallbacks)
+            else:
+                handler.callback = instrument_handler(handler.callback)
+
+    for handlers in application.handlers.values():
+        instrument(handlers)
+
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """نفس طبقة الاتصال الافتراضية بتيليجرام، مع قياس مدة كل طلب حسب اسمه (sendMessage، ...)."""
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await super().do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout
+            )
+        except Exception:
+            TELEGRAM_API_ERRORS.inc(api_method)
+            raise
+        finally:
+            TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, api_method)
+
+
+# ------------------------------------------------------------------------------------------------
+# خادم HTTP صغير لعرض المقاييس
+# ------------------------------------------------------------------------------------------------
+
+class MetricsServer:
+    """يخدم METRICS_PATH بصيغة Prometheus على منفذ منفصل عن الـ Webhook (وإذا انطى token لازم الطلب يرسله)."""
+
+    def __init__(self, port: int, host: str = METRICS_HOST, path: str = METRICS_PATH, token: str = METRICS_TOKEN):
+        self.port = port
+        self.host = host
+        self.path = path
+        self.token = token
+        self._server = None
+
+    async def start(self) -> None:
+        if not self.token and self.host not in ('127.0.0.1', 'localhost', '::1'):
+            logger.warning(f"⚠️ Metrics are exposed on {self.host} without METRICS_TOKEN.")
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"📈 Metrics available on {self.host}:{self.port}{self.path}")
+
+    def _authorized(self, headers: dict) -> bool:
+        if not self.token:
+            return True
+        return hmac.compare_digest(headers.get('authorization', ''), f"Bearer {self.token}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer) -> None:
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) < 2 or request_line[0] != 'GET' or request_line[1].split('?')[0] != self.path:
+                status, body = "404 Not Found", b"not found\n"
+            elif not self._authorized(headers):
+                status, body = "401 Unauthorized", b"unauthorized\n"
+            else:
+                status, body = "200 OK", render_metrics().encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.warning(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
@@ -0,0 +1,159 @@
+# migrations.py
+"""
+ترحيلات قاعدة البيانات المرقمة (Schema Migrations).
+كل ترحيل ينطبق مرة وحدة وينسجل رقمه بجدول SchemaMigrations،
+وعند التشغيل إذا النسخة الحالية = آخر ترحيل ما ننفذ أي DDL.
+لإضافة تغيير على الجداول: أضف ترحيل جديد برقم أكبر بنهاية MIGRATIONS (لا تعدل ترحيل قديم).
+"""
+import logging
+import psycopg2.extras
+
+from secret_codes import hash_secret_code, HASH_PREFIX, SECRET_CODE_PEPPER
+
+logger = logging.getLogger(__name__)
+
+# رقم ثابت لقفل pg_advisory حتى نسختين من البوت ما يطبقون الترحيلات بنفس الوقت
+_MIGRATION_LOCK_ID = 7_032_076_289
+
+
+def _hash_plaintext_secret_codes(cursor):
+    """تشفر الرموز السرية المحفوظة كنص عادي (من قبل secret_codes.py)."""
+    if not SECRET_CODE_PEPPER:
+        # بدون مفتاح التشفير يصير مجرد SHA256 ينكسر بسهولة، فنخلي الترحيل معلق لحد ما ينضبط
+        raise RuntimeError("SECRET_CODE_PEPPER is not set; refusing to hash agent secret codes.")
+    cursor.execute("SELECT id, secret_code FROM Agents WHERE left(secret_code, %s) <> %s", (len(HASH_PREFIX), HASH_PREFIX))
+    rows = [(agent_id, hash_secret_code(code)) for agent_id, code in cursor.fetchall()]
+    if rows:
+        psycopg2.extras.execute_values(
+            cursor,
+            "UPDATE Agents AS A SET secret_code = V.code FROM (VALUES %s) AS V (id, code) WHERE A.id = V.id",
+            rows
+        )
+
+# (الرقم، الوصف، أوامر SQL أو دوال تستلم cursor)
+# الترحيلات الأولى تستخدم IF NOT EXISTS لأن قواعد البيانات القديمة فيها الجداول من setup_db
+MIGRATIONS = [
+    (1, "base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS Shops (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            url TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS Agents (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT UNIQUE,
+            name TEXT NOT NULL,
+            secret_code TEXT NOT NULL UNIQUE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS AgentShops (
+            agent_id INTEGER REFERENCES Agents(id) ON DELETE CASCADE,
+            shop_id INTEGER REFERENCES Shops(id) ON DELETE CASCADE,
+            PRIMARY KEY (agent_id, shop_id)
+        )
+        """,
+        # حفظ حالة المحادثات وبيانات المستخدمين (Persistence)
+        """
+        CREATE TABLE IF NOT EXISTS BotPersistence (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            data BYTEA NOT NULL,
+            PRIMARY KEY (kind, key)
+        )
+        """,
+    ]),
+    (2, "shop list and prefix search indexes", [
+        # للترتيب والتقسيم لصفحات بـ (name, id)
+        "CREATE INDEX IF NOT EXISTS idx_shops_name_id ON Shops (name, id)",
+        # للبحث ببداية الاسم (Inline Mode)
+        "CREATE INDEX IF NOT EXISTS idx_shops_lower_name ON Shops (lower(name) text_pattern_ops)",
+    ]),
+    (3, "reverse assignment and agent list indexes", [
+        # المفتاح الأساسي (agent_id, shop_id) ما يفيد البحث بالمحل: حذف محل، والمجهزين المربوطين بمحل
+        "CREATE INDEX IF NOT EXISTS idx_agentshops_shop_id ON AgentShops (shop_id, agent_id)",
+        # قائمة المجهزين مرتبة بالاسم
+        "CREATE INDEX IF NOT EXISTS idx_agents_name_id ON Agents (name, id)",
+    ]),
+    (4, "hash agent secret codes", [
+        _hash_plaintext_secret_codes,
+    ]),
+    (5, "multi-replica update leases and dedup", [
+        # update_id للتحديثات اللي انعالجت (حتى إعادة إرسال الـ Webhook ما تنعالج مرتين)
+        """
+        CREATE TABLE ProcessedUpdates (
+            update_id BIGINT PRIMARY KEY,
+            processed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        "CREATE INDEX idx_processedupdates_processed_at ON ProcessedUpdates (processed_at)",
+        # النسخة اللي تعالج تحديثات كل (محادثة، مستخدم) هسه
+        """
+        CREATE TABLE UpdateLeases (
+            key TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        )
+        """,
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn) -> int:
+    """آخر ترحيل مطبق (0 إذا جدول الترحيلات غير موجود)."""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('schemamigrations') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return 0
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM SchemaMigrations")
+        return cursor.fetchone()[0]
+
+def apply_migrations(conn) -> int:
+    """
+    تطبق الترحيلات اللي ما انطبقت، كل ترحيل بـ transaction مستقلة. ترجع رقم النسخة بعد التطبيق.
+    إذا القاعدة محدثة ما تنفذ غير استعلام قراءة واحد.
+    """
+    version = current_version(conn)
+    conn.commit()
+    if version >= LATEST_VERSION:
+        return version
+
+    for number, description, statements in MIGRATIONS:
+        with conn.cursor() as cursor:
+            # القفل ينفك تلقائياً مع نهاية الـ transaction
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (_MIGRATION_LOCK_ID,))
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS SchemaMigrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            # نعيد الفحص بعد القفل لأن نسخة ثانية ممكن طبقته قبلنا
+            cursor.execute("SELECT 1 FROM SchemaMigrations WHERE version = %s", (number,))
+            if cursor.fetchone():
+                conn.commit()
+                continue
+            try:
+                for statement in statements:
+                    if callable(statement):
+                        statement(cursor)
+                    else:
+                        cursor.execute(statement)
+                cursor.execute(
+                    "INSERT INTO SchemaMigrations (version, description) VALUES (%s, %s)",
+                    (number, description)
+                )
+            except Exception:
+                conn.rollback()
+                logger.error(f"Migration {number} ({description}) failed")
+                raise
+        conn.commit()
+        version = number
+        logger.info(f"Applied migration {number}: {description}")
+    return version
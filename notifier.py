@@ -0,0 +1,104 @@
+# notifier.py
+"""
+إرسال رسائل لعدد كبير من المجهزين (إشعار جماعي أو تنبيه بتعديل محل) عبر طابور إرسال بعدد عمال محدود.
+الرسائل تنرسل بأولوية "خلفية" حتى ردود البوت التفاعلية تبقى أسرع، وسرعة الإرسال يحددها rate_limiter.py.
+"""
+import os
+import time
+import asyncio
+import logging
+import datetime
+from telegram.error import Forbidden, BadRequest, RetryAfter, TelegramError
+
+from rate_limiter import PRIORITY_BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '30'))
+
+
+class BroadcastReport:
+    """نتيجة إرسال جماعي: عدد اللي وصلتهم الرسالة، اللي فشلت، واللي ما عادوا يستقبلون (حظروا البوت)."""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.delivered = 0
+        self.failed = 0
+        self.unreachable = [] # telegram_id للحسابات اللي حظرت البوت أو انحذفت
+
+    def summary_text(self) -> str:
+        lines = [
+            f"📢 تم الإرسال إلى {self.delivered} من {self.total} مجهز.",
+        ]
+        if self.failed:
+            lines.append(f"❌ فشل الإرسال إلى {self.failed}.")
+        if self.unreachable:
+            lines.append(f"🚫 منهم {len(self.unreachable)} حظروا البوت أو حساباتهم محذوفة.")
+        return "\n".join(lines)
+
+
+async def send_bulk(bot, chat_ids, text: str, parse_mode: str = None) -> BroadcastReport:
+    """
+    ترسل نفس الرسالة لكل chat_ids عبر BROADCAST_CONCURRENCY عامل بالتوازي.
+    ما ترمي أخطاء، كل فشل ينحسب بالتقرير.
+    إذا تيليجرام رجع RetryAfter (مثلاً TELEGRAM_RATE_LIMIT=0 فما اكو rate limiter) كل العمال يوقفون
+    للمدة المطلوبة، ونفس المستلم تنعاد محاولته مرة وحدة قبل ما ينحسب فاشل.
+    """
+    chat_ids = list(dict.fromkeys(chat_ids)) # بدون تكرار وبنفس الترتيب
+    report = BroadcastReport(len(chat_ids))
+    if not chat_ids:
+        return report
+
+    # rate_limit_args مسموح بس إذا الـ bot عنده rate limiter
+    send_kwargs = {'rate_limit_args': {'priority': PRIORITY_BACKGROUND}} if getattr(bot, 'rate_limiter', None) else {}
+    queue = asyncio.Queue()
+    for chat_id in chat_ids:
+        queue.put_nowait(chat_id)
+    resume_at = 0.0 # time.monotonic() لنهاية آخر RetryAfter (لكل العمال)
+
+    async def send(chat_id):
+        nonlocal resume_at
+        for attempt in range(2):
+            delay = resume_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode, **send_kwargs)
+                return
+            except RetryAfter as e:
+                if attempt:
+                    raise
+                retry_after = e.retry_after
+                if isinstance(retry_after, datetime.timedelta):
+                    retry_after = retry_after.total_seconds()
+                logger.warning(f"Flood control while notifying agents: pausing {retry_after}s")
+                resume_at = max(resume_at, time.monotonic() + retry_after)
+
+    async def worker():
+        while True:
+            try:
+                chat_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await send(chat_id)
+                report.delivered += 1
+            except Forbidden as e:
+                # حظر البوت أو الحساب انحذف
+                report.failed += 1
+                report.unreachable.append(chat_id)
+                logger.info(f"Agent chat {chat_id} is unreachable: {e}")
+            except BadRequest as e:
+                report.failed += 1
+                if 'chat not found' in str(e).lower():
+                    report.unreachable.append(chat_id)
+                    logger.info(f"Agent chat {chat_id} is unreachable: {e}")
+                else:
+                    logger.warning(f"Failed to notify agent chat {chat_id}: {e}")
+            except TelegramError as e:
+                report.failed += 1
+                logger.warning(f"Failed to notify agent chat {chat_id}: {e}")
+
+    workers = min(BROADCAST_CONCURRENCY, len(chat_ids))
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    return report
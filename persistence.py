@@ -0,0 +1,139 @@
+# persistence.py
+"""
+حفظ حالة المحادثات وبيانات المستخدمين (user_data / chat_data) بقاعدة PostgreSQL،
+حتى إعادة تشغيل البوت ما تطلّع المجهزين من حساباتهم.
+التغييرات تتجمع بالذاكرة وتنكتب على دفعات (كل دفعة = transaction واحد).
+بوضع النسخ المتعددة (shared=True) ما نحمل ولا نكتب هنا: replicas.py يحمل حالة كل مستخدم
+قبل تحديثه ويحفظها بعده، حتى نسخة ما تكتب فوق حالة أحدث كتبتها نسخة ثانية.
+"""
+import os
+import json
+import pickle
+import asyncio
+import logging
+from telegram.ext import BasePersistence, PersistenceInput
+
+from database import load_persistence, save_persistence
+from async_db import run_db
+
+logger = logging.getLogger(__name__)
+
+# كل كم ثانية يسلّم البوت التغييرات للـ Persistence
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '30'))
+# مهلة قصيرة لتجميع كل التغييرات اللي توصل بنفس الدورة بدفعة وحدة
+_FLUSH_DELAY = 0.5
+
+_DELETED = object()
+
+
+def conversation_kind(name: str) -> str:
+    return f'conversation:{name}'
+
+def conversation_key(key: tuple) -> str:
+    return json.dumps(list(key))
+
+
+class PostgresPersistence(BasePersistence):
+    """Persistence يخزن user_data و chat_data وحالات الـ ConversationHandler بجدول BotPersistence."""
+
+    def __init__(self, update_interval: float = PERSISTENCE_INTERVAL, shared: bool = False):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._shared = shared
+        self._buffer = {} # (kind, key) -> bytes أو _DELETED
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    # --------------------------------------------------------------------------------------------
+    # التحميل عند التشغيل
+    # --------------------------------------------------------------------------------------------
+
+    async def _load(self, kind: str) -> dict:
+        if self._shared:
+            return {}
+        rows = await run_db(load_persistence, kind)
+        return {key: pickle.loads(data) for key, data in rows.items()}
+
+    async def get_user_data(self) -> dict:
+        return {int(key): value for key, value in (await self._load('user_data')).items()}
+
+    async def get_chat_data(self) -> dict:
+        return {int(key): value for key, value in (await self._load('chat_data')).items()}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        rows = await self._load(conversation_kind(name))
+        return {tuple(json.loads(key)): state for key, state in rows.items()}
+
+    # --------------------------------------------------------------------------------------------
+    # التغييرات (تنحفظ بالذاكرة وتنكتب على دفعات)
+    # --------------------------------------------------------------------------------------------
+
+    def _buffer_write(self, kind: str, key: str, value) -> None:
+        if self._shared:
+            return
+        self._buffer[(kind, key)] = _DELETED if value is _DELETED else pickle.dumps(value)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._buffer_write('user_data', str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._buffer_write('chat_data', str(chat_id), data)
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        value = _DELETED if new_state is None else new_state
+        self._buffer_write(conversation_kind(name), conversation_key(key), value)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._buffer_write('user_data', str(user_id), _DELETED)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._buffer_write('chat_data', str(chat_id), _DELETED)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    # --------------------------------------------------------------------------------------------
+    # الكتابة للقاعدة
+    # --------------------------------------------------------------------------------------------
+
+    async def _flush_soon(self) -> None:
+        await asyncio.sleep(_FLUSH_DELAY)
+        await self.flush()
+
+    async def flush(self) -> None:
+        """تكتب كل التغييرات المتجمعة بـ transaction واحد."""
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            pending, self._buffer = self._buffer, {}
+            upserts = [(kind, key, data) for (kind, key), data in pending.items() if data is not _DELETED]
+            deletes = [(kind, key) for (kind, key), data in pending.items() if data is _DELETED]
+            try:
+                await run_db(save_persistence, upserts, deletes)
+            except Exception as e:
+                logger.error(f"Error flushing persistence ({len(pending)} entries): {e}")
+                # نرجع التغييرات للمخزن المؤقت (بدون ما نغطي على تغييرات أحدث) حتى تنكتب بالدفعة الجاية
+                for entry_key, data in pending.items():
+                    self._buffer.setdefault(entry_key, data)
@@ -0,0 +1,109 @@
+# query_profiler.py
+"""
+تحليل أداء الاستعلامات داخل execute_query (يشتغل فقط إذا DB_PROFILE=1).
+يسجل مدة وعدد صفوف كل استعلام ويجمعها حسب نص الاستعلام الموحد،
+ويكتب بالـ log الاستعلامات الأبطأ من DB_SLOW_QUERY_MS (مع إخفاء قيم المعاملات)،
+واختيارياً (DB_EXPLAIN_SLOW=1) يسجل خطة التنفيذ EXPLAIN (ANALYZE, BUFFERS) لها.
+"""
+import os
+import re
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ENABLED = os.getenv('DB_PROFILE', '0') == '1'
+SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', '200'))
+EXPLAIN_SLOW = os.getenv('DB_EXPLAIN_SLOW', '0') == '1'
+# أقل مدة (بالثواني) بين خطتين لنفس الاستعلام، حتى EXPLAIN ANALYZE ما يضاعف الحمل
+EXPLAIN_INTERVAL = float(os.getenv('DB_EXPLAIN_INTERVAL', '300'))
+
+_stats = {} # نص الاستعلام الموحد -> QueryStats
+_last_explained = {} # نص الاستعلام الموحد -> آخر وقت سجلنا خطته
+_lock = threading.Lock()
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+class QueryStats:
+    """إحصائيات استعلام واحد (بعد التوحيد)."""
+
+    __slots__ = ('query', 'calls', 'total_seconds', 'max_seconds', 'rows', 'slow_calls', 'last_plan')
+
+    def __init__(self, query: str):
+        self.query = query
+        self.calls = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.slow_calls = 0
+        self.last_plan = None
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.total_seconds / self.calls if self.calls else 0.0
+
+
+def normalize_query(query: str) -> str:
+    """توحيد نص الاستعلام (المسافات والأسطر) حتى تتجمع كل استدعاءاته بسجل واحد."""
+    return _WHITESPACE.sub(' ', query).strip()
+
+def redact_params(params) -> str:
+    """تعرض نوع وطول كل معامل بدل قيمته (حتى ما تنكتب الرموز السرية والأسماء بالـ log)."""
+    if params is None:
+        return "()"
+    redacted = []
+    for value in params:
+        if value is None:
+            redacted.append("NULL")
+        elif isinstance(value, (str, bytes)):
+            redacted.append(f"<{type(value).__name__}:{len(value)}>")
+        else:
+            redacted.append(f"<{type(value).__name__}>")
+    return "(" + ", ".join(redacted) + ")"
+
+def record(query: str, params, seconds: float, rowcount: int) -> bool:
+    """
+    تسجل تنفيذ استعلام. ترجع True إذا لازم نسجل خطة تنفيذه (بطيء و EXPLAIN مفعّل ولم نسجلها مؤخراً).
+    """
+    normalized = normalize_query(query)
+    is_slow = seconds * 1000 >= SLOW_QUERY_MS
+    now = time.monotonic()
+    with _lock:
+        stats = _stats.get(normalized)
+        if stats is None:
+            stats = _stats[normalized] = QueryStats(normalized)
+        stats.calls += 1
+        stats.total_seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+        stats.rows += max(rowcount, 0)
+        if not is_slow:
+            return False
+        stats.slow_calls += 1
+        wants_plan = EXPLAIN_SLOW and now - _last_explained.get(normalized, float('-inf')) >= EXPLAIN_INTERVAL
+        if wants_plan:
+            _last_explained[normalized] = now
+
+    logger.warning(f"Slow query ({seconds * 1000:.1f} ms, {rowcount} rows): {normalized} params={redact_params(params)}")
+    return wants_plan
+
+def record_plan(query: str, plan: str) -> None:
+    """تحفظ وتسجل بالـ log خطة تنفيذ استعلام بطيء."""
+    normalized = normalize_query(query)
+    with _lock:
+        stats = _stats.get(normalized)
+        if stats is not None:
+            stats.last_plan = plan
+    logger.warning(f"Plan for slow query: {normalized}\n{plan}")
+
+def get_query_stats(limit: int = 10) -> list:
+    """أكثر الاستعلامات استهلاكاً للوقت (مجموع المدة)."""
+    with _lock:
+        stats = sorted(_stats.values(), key=lambda s: s.total_seconds, reverse=True)
+    return stats[:limit]
+
+def reset_query_stats() -> None:
+    with _lock:
+        _stats.clear()
+        _last_explained.clear()
@@ -0,0 +1,159 @@
+# rate_limiter.py
+"""
+تنظيم الطلبات الصادرة لتيليجرام حتى ما نوصل لأخطاء 429 (Flood control):
+حد عام لكل البوت وحد لكل محادثة، مع إعادة المحاولة بعد retry_after،
+والردود التفاعلية (ضغطات وأوامر المستخدمين) لها أولوية على الإرسال بالخلفية (مثل الإشعارات الجماعية).
+بدون aiolimiter حتى ما نضيف اعتماديات جديدة.
+"""
+import os
+import time
+import asyncio
+import logging
+import datetime
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import TELEGRAM_RATE_LIMIT_WAIT_SECONDS, TELEGRAM_RETRY_AFTER
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_RATE_LIMIT = os.getenv('TELEGRAM_RATE_LIMIT', '1') == '1'
+# حدود تيليجرام المعروفة: ~30 رسالة بالثانية للبوت، ~1 بالثانية للمحادثة الخاصة، 20 بالدقيقة للمجموعة
+# (الحد لكل نسخة من البوت: بوضع النسخ المتعددة قسم TELEGRAM_GLOBAL_RATE على عدد النسخ)
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+TELEGRAM_GROUP_RATE_PER_MIN = float(os.getenv('TELEGRAM_GROUP_RATE_PER_MIN', '20'))
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', '3'))
+
+# القيم المسموحة لـ rate_limit_args={'priority': ...}
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BACKGROUND = 'background'
+
+# طلبات ما تنحسب على حد المحادثة (ردود فورية على المستخدم وما تظهر كرسائل)
+_UNLIMITED_PER_CHAT = {'answerCallbackQuery', 'answerInlineQuery', 'sendChatAction'}
+# نحذف حدود المحادثات الخاملة إذا صار عددها أكثر من هذا
+_MAX_CHAT_BUCKETS = 10000
+
+
+class TokenBucket:
+    """دلو رموز: يسمح بـ capacity طلب دفعة وحدة ثم rate طلب بالثانية."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """كم ثانية لازم ننتظر قبل ما يتوفر رمز (0 إذا متوفر هسه)."""
+        self._refill(time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def is_idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """
+    ينتظر قبل كل طلب حتى يتوفر مكان بالحد العام وحد المحادثة، والطلبات التفاعلية تسبق طلبات الخلفية.
+    إذا تيليجرام رجع RetryAfter يوقف كل الطلبات للمدة المطلوبة ويعيد المحاولة (لحد TELEGRAM_MAX_RETRIES).
+    """
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: int = TELEGRAM_CHAT_BURST, group_rate_per_min: float = TELEGRAM_GROUP_RATE_PER_MIN,
+                 max_retries: int = TELEGRAM_MAX_RETRIES):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._group_rate = group_rate_per_min / 60
+        self._max_retries = max_retries
+        self._chats = {} # chat_id -> TokenBucket
+        self._blocked_until = 0.0 # نهاية آخر RetryAfter (للبوت كله)
+        self._interactive_waiting = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= _MAX_CHAT_BUCKETS:
+                self._chats = {key: b for key, b in self._chats.items() if not b.is_idle()}
+            # المعرفات السالبة (أو @username) مجموعات وقنوات
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            if is_group:
+                bucket = TokenBucket(self._group_rate, 1)
+            else:
+                bucket = TokenBucket(self._chat_rate, self._chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id, interactive: bool) -> None:
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        # الطلب التفاعلي ينحسب ضمن _interactive_waiting بس وهو ينتظر الحد العام (أو RetryAfter)،
+        # مو وهو ينتظر حد محادثته، حتى طلبات الخلفية ما توقف بلا داعي والحد العام فاضي
+        waiting_global = False
+        try:
+            while True:
+                chat_delay = chat_bucket.delay() if chat_bucket else 0.0
+                if chat_delay > 0:
+                    if waiting_global:
+                        self._interactive_waiting -= 1
+                        waiting_global = False
+                    await asyncio.sleep(chat_delay)
+                    continue
+                if interactive and not waiting_global:
+                    self._interactive_waiting += 1
+                    waiting_global = True
+                delay = self._blocked_until - time.monotonic()
+                if delay <= 0 and not interactive and self._interactive_waiting:
+                    # طلبات الخلفية تترك المكان للتفاعلية اللي تنتظر الحد العام
+                    delay = 1 / self._global.rate
+                if delay <= 0:
+                    delay = self._global.delay()
+                if delay <= 0:
+                    # ما اكو await بين الفحص والأخذ، فالرموز ما تنأخذ من طلب ثاني بالنص
+                    self._global.take()
+                    if chat_bucket:
+                        chat_bucket.take()
+                    return
+                await asyncio.sleep(delay)
+        finally:
+            if waiting_global:
+                self._interactive_waiting -= 1
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = (rate_limit_args or {}).get('priority', PRIORITY_INTERACTIVE)
+        interactive = priority != PRIORITY_BACKGROUND
+        chat_id = None if endpoint in _UNLIMITED_PER_CHAT else data.get('chat_id')
+
+        for attempt in range(self._max_retries + 1):
+            started = time.perf_counter()
+            await self._acquire(chat_id, interactive)
+            TELEGRAM_RATE_LIMIT_WAIT_SECONDS.observe(time.perf_counter() - started, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, datetime.timedelta):
+                    retry_after = retry_after.total_seconds()
+                TELEGRAM_RETRY_AFTER.inc(endpoint)
+                if attempt >= self._max_retries:
+                    raise
+                logger.warning(f"Flood control on {endpoint}: retrying in {retry_after}s (attempt {attempt + 1})")
+                # الحظر على البوت كله، فنوقف كل الطلبات مو بس هذا
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after + 0.1)
@@ -0,0 +1,51 @@
+# render_cache.py
+"""
+كاش للشاشات الجاهزة (النص + InlineKeyboardMarkup) حتى ما نعيد بناء آلاف الأزرار بكل ضغطة.
+المفتاح = (اسم الشاشة، معاملاتها مثل الصفحة أو المجهز)،
+وكل الكاش ينمسح أول ما تتغير نسخة بيانات المحلات والمجهزين (get_catalog_version).
+الشاشة اللي فشل استعلام أثناء بنائها ما تنخزن، وكل شاشة مخزنة تنتهي بعد RENDER_CACHE_TTL.
+"""
+import os
+import time
+from collections import OrderedDict
+
+from database import get_catalog_version, get_query_failure_count
+from metrics import RENDER_CACHE_REQUESTS
+
+RENDER_CACHE_MAX_ENTRIES = int(os.getenv('RENDER_CACHE_MAX_ENTRIES', '512'))
+RENDER_CACHE_TTL = float(os.getenv('RENDER_CACHE_TTL', '300'))
+
+
+_cache = OrderedDict() # key -> (expires_at, (text, reply_markup, ...))
+_cache_version = None
+
+
+async def get_or_render(key: tuple, render):
+    """
+    ترجع نتيجة الشاشة (text, reply_markup، وأحياناً مؤشرات الصفحات) من الكاش إذا موجودة لنفس نسخة البيانات وما انتهت،
+    وإلا تستدعي render() (دالة async) وتخزن نتيجتها إذا ما فشل أي استعلام أثناءها.
+    """
+    global _cache_version
+    version = get_catalog_version()
+    if version != _cache_version:
+        _cache.clear()
+        _cache_version = version
+
+    now = time.monotonic()
+    cached = _cache.get(key)
+    if cached is not None and cached[0] > now:
+        _cache.move_to_end(key)
+        RENDER_CACHE_REQUESTS.inc(key[0], "hit")
+        return cached[1]
+
+    RENDER_CACHE_REQUESTS.inc(key[0], "miss")
+    failures = get_query_failure_count()
+    result = await render()
+    # إذا تغيرت البيانات أثناء البناء، النتيجة ممكن تكون قديمة فما نخزنها.
+    # وإذا فشل استعلام (حتى لو من مستخدم ثاني بنفس الوقت) الشاشة ممكن تكون فاضية بالغلط
+    if get_catalog_version() == version and get_query_failure_count() == failures:
+        _cache[key] = (now + RENDER_CACHE_TTL, result)
+        _cache.move_to_end(key)
+        while len(_cache) > RENDER_CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+    return result
@@ -0,0 +1,224 @@
+# replicas.py
+"""
+وضع النسخ المتعددة (MULTI_REPLICA=1): أكثر من نسخة من البوت خلف نفس الـ Webhook وعلى نفس القاعدة.
+- كل تحديث يسجل update_id بجدول ProcessedUpdates بعد ما تخلص معالجته، فإعادة إرسال تيليجرام لنفس التحديث
+  ما تنعالج مرتين، والتحديث اللي وقفت نسخته بنصه ينعاد (مرة على الأقل، مو مرة بالكثير).
+- تحديثات كل (محادثة، مستخدم) تمشي بالتسلسل عبر إيجار (lease) بجدول UpdateLeases،
+  وحالة المحادثة و user_data / chat_data تنقرأ من القاعدة قبل التحديث وتنحفظ بعده تحت نفس الإيجار.
+- تعديل المحلات أو المجهزين بنسخة يبلغ الباقي (LISTEN/NOTIFY) حتى يفرغون الكاش وفهرس الجلسات،
+  وتسجيل دخول مجهز يفرغ فهرس الجلسات بس (الكاش يبقى).
+"""
+import os
+import time
+import json
+import pickle
+import select
+import asyncio
+import logging
+import threading
+import psycopg2
+from telegram import Update
+
+import database
+from async_db import run_db
+from persistence import conversation_kind, conversation_key
+from metrics import UPDATE_LEASE_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+MULTI_REPLICA = database.MULTI_REPLICA
+# مدة الإيجار (تتمدد تلقائياً إذا المعالجة طولت). إذا نسخة وقفت فجأة مستخدميها ينتظرون هالمدة كحد أقصى
+UPDATE_LEASE_SECONDS = float(os.getenv('UPDATE_LEASE_SECONDS', '30'))
+# كم نحتفظ بـ update_id المعالجة (تيليجرام يعيد إرسال التحديث خلال هالمدة بالكثير)
+UPDATE_DEDUP_RETENTION_HOURS = float(os.getenv('UPDATE_DEDUP_RETENTION_HOURS', '24'))
+# فترات الانتظار قبل إعادة محاولة أخذ إيجار مشغول (تتضاعف لحد الأقصى)
+_LEASE_RETRY_MIN = 0.02
+_LEASE_RETRY_MAX = 0.5
+_PRUNE_INTERVAL = 600
+
+
+class _SharedUpdate:
+    """اللي نحتاجه بين بداية التحديث ونهايته: الإيجار والحالة المحملة (لنعرف شنو تغير)."""
+
+    __slots__ = ('update_id', 'lease_key', 'chat_id', 'user_id', 'loaded', 'renew_task')
+
+    def __init__(self, update_id, lease_key, chat_id, user_id, loaded):
+        self.update_id = update_id
+        self.lease_key = lease_key
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.loaded = loaded # (kind, key) -> bytes كما انقرأت من القاعدة
+        self.renew_task = None
+
+
+class ReplicaCoordinator:
+    """
+    يستخدمه PerUserUpdateProcessor حول كل تحديث: begin قبل المعالجة (ترجع None إذا التحديث مكرر)
+    و end بعدها. الحالة تتبدل مباشرة بقواميس الـ Application والـ ConversationHandler.
+    """
+
+    def __init__(self, application, owner: str = database.REPLICA_ID,
+                 lease_seconds: float = UPDATE_LEASE_SECONDS):
+        # نعتمد على تفاصيل داخلية بـ python-telegram-bot (النسخة مثبتة بـ requirements.txt)،
+        # فإذا تغيرت نوقف من البداية بدل ما تضيع حالة المحادثات بصمت
+        if not hasattr(application, '_conversation_handler_conversations'):
+            raise RuntimeError("Unsupported python-telegram-bot version for MULTI_REPLICA mode.")
+        self._application = application
+        self._owner = owner
+        self._lease_seconds = lease_seconds
+        self._last_prune = 0.0
+
+    def _conversations(self) -> dict:
+        # الـ Application تبدل قواميس المحادثات بـ TrackingDict عند initialize، فنقراها كل مرة
+        return self._application._conversation_handler_conversations
+
+    def _state_keys(self, chat_id, user_id) -> list:
+        keys = []
+        if user_id is not None:
+            keys.append(('user_data', str(user_id)))
+        if chat_id is not None:
+            keys.append(('chat_data', str(chat_id)))
+            if user_id is not None:
+                for name in self._conversations():
+                    keys.append((conversation_kind(name), conversation_key((chat_id, user_id))))
+        return keys
+
+    def _current_state(self, chat_id, user_id) -> dict:
+        """حالة المستخدم الحالية بالذاكرة كـ (kind, key) -> bytes (أو None إذا ما موجودة)."""
+        state = {}
+        # user_data / chat_data الفاضية نعاملها كغير موجودة حتى ما نكتب سجل لكل مستخدم جديد
+        if user_id is not None:
+            state[('user_data', str(user_id))] = self._application.user_data.get(user_id) or None
+        if chat_id is not None:
+            state[('chat_data', str(chat_id))] = self._application.chat_data.get(chat_id) or None
+            if user_id is not None:
+                for name, conversations in self._conversations().items():
+                    state[(conversation_kind(name), conversation_key((chat_id, user_id)))] = \
+                        conversations.get((chat_id, user_id))
+        return {entry: None if value is None else pickle.dumps(value) for entry, value in state.items()}
+
+    def _install_state(self, chat_id, user_id, loaded: dict) -> None:
+        """تبدل حالة المستخدم بالذاكرة بالحالة المحفوظة بالقاعدة (بدون ما تنحسب كتغيير)."""
+        if user_id is not None:
+            data = loaded.get(('user_data', str(user_id)))
+            user_data = self._application.user_data[user_id]
+            user_data.clear()
+            if data is not None:
+                user_data.update(pickle.loads(data))
+        if chat_id is not None:
+            data = loaded.get(('chat_data', str(chat_id)))
+            chat_data = self._application.chat_data[chat_id]
+            chat_data.clear()
+            if data is not None:
+                chat_data.update(pickle.loads(data))
+            if user_id is not None:
+                key = (chat_id, user_id)
+                for name, conversations in self._conversations().items():
+                    data = loaded.get((conversation_kind(name), conversation_key(key)))
+                    if data is None:
+                        conversations.data.pop(key, None)
+                    else:
+                        conversations.update_no_track({key: pickle.loads(data)})
+
+    async def begin(self, update: object, key):
+        """تاخذ الإيجار وتحمل حالة المستخدم. ترجع None إذا التحديث انعالج قبل (بهالنسخة أو بغيرها)."""
+        chat_id, user_id = key if key is not None else (None, None)
+        lease_key = json.dumps([chat_id, user_id]) if key is not None else None
+        state_keys = self._state_keys(chat_id, user_id)
+        update_id = update.update_id if isinstance(update, Update) else None
+
+        started = time.perf_counter()
+        retry = _LEASE_RETRY_MIN
+        while True:
+            if update_id is None and lease_key is None:
+                result = {}
+                break
+            result = await run_db(database.begin_shared_update, update_id, lease_key, self._owner,
+                                  self._lease_seconds, state_keys)
+            if result != database.LEASE_BUSY:
+                break
+            # نسخة ثانية تعالج تحديث لنفس المستخدم، ننتظر تخلص
+            await asyncio.sleep(retry)
+            retry = min(retry * 2, _LEASE_RETRY_MAX)
+        UPDATE_LEASE_WAIT_SECONDS.observe(time.perf_counter() - started)
+
+        self._maybe_prune()
+        if result == database.DUPLICATE_UPDATE:
+            return None
+
+        self._install_state(chat_id, user_id, result)
+        shared = _SharedUpdate(update_id, lease_key, chat_id, user_id, result)
+        if lease_key is not None:
+            shared.renew_task = asyncio.create_task(self._renew(lease_key))
+        return shared
+
+    async def end(self, shared: _SharedUpdate) -> None:
+        """تسجل التحديث كمعالج، تحفظ اللي تغير من حالة المستخدم وتفك الإيجار."""
+        if shared.renew_task is not None:
+            shared.renew_task.cancel()
+        upserts, deletes = [], []
+        for entry, data in self._current_state(shared.chat_id, shared.user_id).items():
+            if data == shared.loaded.get(entry):
+                continue
+            if data is None:
+                deletes.append(entry)
+            else:
+                upserts.append((*entry, data))
+        if shared.update_id is None and shared.lease_key is None and not upserts and not deletes:
+            return
+        await run_db(database.end_shared_update, shared.update_id, shared.lease_key, self._owner,
+                     upserts, deletes)
+
+    async def _renew(self, lease_key: str) -> None:
+        while True:
+            await asyncio.sleep(self._lease_seconds / 3)
+            try:
+                if not await run_db(database.renew_update_lease, lease_key, self._owner, self._lease_seconds):
+                    logger.warning(f"Lost update lease {lease_key}")
+                    return
+            except Exception as e:
+                logger.error(f"Error renewing update lease {lease_key}: {e}")
+
+    def _maybe_prune(self) -> None:
+        now = time.monotonic()
+        if now - self._last_prune < _PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        self._application.create_task(
+            run_db(database.prune_processed_updates, UPDATE_DEDUP_RETENTION_HOURS * 3600)
+        )
+
+
+def start_change_listener() -> threading.Thread:
+    """
+    تشغل خيط يستمع لقناة التعديلات (LISTEN) على اتصال مستقل،
+    ولما نسخة ثانية تعدل المحلات أو المجهزين يفرغ الكاش المحلي.
+    """
+    thread = threading.Thread(target=_listen_for_changes, name="db-changes", daemon=True)
+    thread.start()
+    return thread
+
+def _listen_for_changes() -> None:
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(database.DATABASE_URL)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {database.CHANGES_CHANNEL}")
+            # ممكن فاتتنا تعديلات قبل ما نبدي نستمع
+            database.apply_remote_change()
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                changes = [database.parse_change(n.payload) for n in conn.notifies]
+                conn.notifies.clear()
+                kinds = {kind for kind, replica_id in changes if replica_id != database.REPLICA_ID}
+                if kinds:
+                    database.apply_remote_change(kinds)
+        except Exception as e:
+            logger.error(f"Change listener disconnected: {e}")
+            if conn is not None and not conn.closed:
+                conn.close()
+            time.sleep(5)
@@ -0,0 +1,20 @@
+# secret_codes.py
+"""
+تشفير الرموز السرية للمجهزين قبل حفظها بقاعدة البيانات.
+نستخدم HMAC-SHA256 بمفتاح سري من البيئة (SECRET_CODE_PEPPER): نفس الرمز يعطي نفس الناتج دائماً،
+فيبقى البحث بالرمز والقيد UNIQUE شغالين، وتسريب قاعدة البيانات وحده ما يكشف الرموز.
+تنبيه: تغيير SECRET_CODE_PEPPER بعد التشغيل يبطل كل الرموز المحفوظة، وبدونه البوت ما يشتغل.
+"""
+import os
+import hmac
+import hashlib
+
+SECRET_CODE_PEPPER = os.getenv('SECRET_CODE_PEPPER', '')
+
+# بادئة تميز الرموز المشفرة عن الرموز القديمة المحفوظة كنص عادي
+HASH_PREFIX = 'h1$'
+
+
+def hash_secret_code(code: str) -> str:
+    digest = hmac.new(SECRET_CODE_PEPPER.encode(), code.encode(), hashlib.sha256).hexdigest()
+    return HASH_PREFIX + digest
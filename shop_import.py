@@ -0,0 +1,135 @@
+# shop_import.py
+"""
+إضافة المحلات بالجملة: من رسالة وحدة فيها عدة محلات (الاسم والرابط بسطرين لكل محل)
+أو من ملف CSV/TSV (عمودين: الاسم، الرابط). الصفوف تُقرأ وحدة وحدة وتُضاف على دفعات.
+"""
+import os
+import csv
+import io
+
+from database import add_shops_bulk
+
+# عدد المحلات بكل أمر INSERT
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '500'))
+# أكثر عدد تفاصيل (أخطاء/مكررات) تنعرض بالملخص
+REPORT_DETAILS_LIMIT = 15
+
+# كلمات تدل إن أول سطر بالملف هو عناوين الأعمدة
+_HEADER_NAMES = {'name', 'shop', 'الاسم', 'اسم المحل', 'المحل'}
+
+
+class ImportReport:
+    """ملخص عملية الإضافة بالجملة."""
+
+    def __init__(self):
+        self.inserted = 0
+        self.skipped = [] # [(رقم السطر، الاسم)] أسماء مكررة
+        self.errors = [] # [(رقم السطر، السبب)]
+
+    def summary_text(self) -> str:
+        """نص الملخص اللي يوصل للمدير برسالة وحدة."""
+        lines = [
+            "📦 نتيجة الإضافة بالجملة:",
+            f"✅ تمت الإضافة: {self.inserted}",
+            f"⏭️ مكرر (تم تجاهله): {len(self.skipped)}",
+            f"❌ أخطاء: {len(self.errors)}",
+        ]
+        details = [(line, f"⏭️ سطر {line}: {name} (موجود مسبقاً)") for line, name in self.skipped]
+        details += [(line, f"❌ سطر {line}: {reason}") for line, reason in self.errors]
+        details = [text for _, text in sorted(details)]
+        if details:
+            lines.append("")
+            lines.extend(details[:REPORT_DETAILS_LIMIT])
+            if len(details) > REPORT_DETAILS_LIMIT:
+                lines.append(f"... و {len(details) - REPORT_DETAILS_LIMIT} أخرى")
+        return "\n".join(lines)
+
+
+def iter_message_rows(text: str):
+    """تقرأ رسالة فيها عدة محلات: كل محل سطرين (الاسم ثم الرابط). ترجع (رقم السطر، الاسم، الرابط)."""
+    pending = None
+    for line_no, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        if pending is None:
+            pending = (line_no, line)
+        else:
+            yield pending[0], pending[1], line
+            pending = None
+    if pending is not None:
+        # اسم بدون رابط بآخر الرسالة
+        yield pending[0], pending[1], None
+
+
+def iter_delimited_rows(lines):
+    """
+    تقرأ ملف CSV أو TSV سطر بسطر (الفاصل يتحدد من أول سطر). ترجع (رقم السطر، الاسم، الرابط).
+    سطر العناوين (name,url) يتم تجاهله.
+    """
+    lines = iter(lines)
+    first_line = next(lines, None)
+    if first_line is None:
+        return
+    delimiter = '\t' if '\t' in first_line else ','
+
+    def all_lines():
+        yield first_line
+        yield from lines
+
+    reader = csv.reader(all_lines(), delimiter=delimiter)
+    for row in reader:
+        line_no = reader.line_num
+        cells = [cell.strip() for cell in row]
+        if not any(cells):
+            continue
+        if line_no == 1 and cells[0].lower() in _HEADER_NAMES:
+            continue
+        if len(cells) < 2:
+            yield line_no, cells[0], None
+        else:
+            yield line_no, cells[0], cells[1]
+
+
+def iter_document_rows(data: bytes):
+    """تقرأ محتوى ملف مرفوع (UTF-8) كـ CSV/TSV."""
+    stream = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', errors='replace', newline='')
+    return iter_delimited_rows(stream)
+
+
+def import_shops(rows) -> ImportReport:
+    """
+    تضيف المحلات من (رقم السطر، الاسم، الرابط) على دفعات بحجم IMPORT_BATCH_SIZE.
+    الأسماء المكررة داخل نفس الملف/الرسالة أو الموجودة مسبقاً بالقاعدة تُسجل كمكررة.
+    """
+    report = ImportReport()
+    seen_names = set()
+    batch = [] # [(رقم السطر، الاسم، الرابط)]
+
+    def flush():
+        inserted_names = add_shops_bulk([(name, url) for _, name, url in batch])
+        if inserted_names is None:
+            report.errors.extend((line_no, "خطأ في قاعدة البيانات") for line_no, _, _ in batch)
+        else:
+            for line_no, name, _ in batch:
+                if name in inserted_names:
+                    report.inserted += 1
+                else:
+                    report.skipped.append((line_no, name))
+        batch.clear()
+
+    for line_no, name, url in rows:
+        if not name or not url:
+            report.errors.append((line_no, f"{name or '؟'}: الاسم أو الرابط ناقص"))
+            continue
+        if name in seen_names:
+            report.skipped.append((line_no, name))
+            continue
+        seen_names.add(name)
+        batch.append((line_no, name, url))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            flush()
+
+    if batch:
+        flush()
+    return report
@@ -0,0 +1,98 @@
+# throttling.py
+"""
+حماية قاعدة البيانات من المستخدمين اللي يرسلون رسائل بسرعة (تخمين الرموز السرية أو بحث متواصل):
+دلو رموز لكل مستخدم ولكل نوع معالج، وحد عام لعدد المعالجات اللي تشتغل على قاعدة البيانات بنفس الوقت.
+إذا انتهى الحد نرد فوراً "تمهل" (مرة وحدة لكل فترة) بدون ما نلمس قاعدة البيانات.
+الحدود بذاكرة كل نسخة من البوت، فبوضع النسخ المتعددة الحد الفعلي يتضاعف بعدد النسخ بالكثير.
+"""
+import os
+import time
+import asyncio
+import functools
+import logging
+
+from rate_limiter import TokenBucket
+from metrics import HANDLER_THROTTLED
+
+logger = logging.getLogger(__name__)
+
+# محاولات تسجيل الدخول: 5 محاولات متتالية ثم محاولة كل 12 ثانية
+LOGIN_ATTEMPTS_PER_MIN = float(os.getenv('LOGIN_ATTEMPTS_PER_MIN', '5'))
+LOGIN_BURST = int(os.getenv('LOGIN_BURST', '5'))
+# البحث: 5 عمليات متتالية ثم عملية بالثانية
+SEARCHES_PER_SEC = float(os.getenv('SEARCHES_PER_SEC', '1'))
+SEARCH_BURST = int(os.getenv('SEARCH_BURST', '5'))
+# أقصى عدد معالجات تشتغل على قاعدة البيانات بنفس الوقت (الباقي يترفض فوراً)
+DB_HANDLER_CONCURRENCY = int(os.getenv('DB_HANDLER_CONCURRENCY', '32'))
+
+_LIMITS = {
+    'login': (LOGIN_ATTEMPTS_PER_MIN / 60, LOGIN_BURST),
+    'search': (SEARCHES_PER_SEC, SEARCH_BURST),
+}
+_MESSAGES = {
+    'login': "⏳ محاولات كثيرة. انتظر شوية وحاول مرة ثانية.",
+    'search': "⏳ تمهل شوية، البحث كثير ورا بعض.",
+    'busy': "⏳ البوت مشغول هسه، حاول بعد ثواني.",
+}
+# ما نكرر رسالة "تمهل" لنفس المستخدم أكثر من مرة خلال هالمدة
+_WARN_INTERVAL = 10.0
+_MAX_BUCKETS = 10000
+
+_buckets = {} # (kind, user_id) -> TokenBucket
+_warned = {} # (reason, user_id) -> آخر وقت أرسلنا بيه "تمهل"
+_db_slots = None # asyncio.Semaphore، ينشأ أول مرة داخل الـ event loop
+
+
+def _allow(kind: str, user_id: int) -> bool:
+    key = (kind, user_id)
+    bucket = _buckets.get(key)
+    if bucket is None:
+        if len(_buckets) >= _MAX_BUCKETS:
+            for stale in [k for k, b in _buckets.items() if b.is_idle()]:
+                del _buckets[stale]
+            # "تمهل" اللي مرت مدتها ما عاد إلها داعي، لكل الأسباب (ومنها 'busy' اللي ما إلها دلو)
+            now = time.monotonic()
+            for stale in [k for k, warned_at in _warned.items() if now - warned_at >= _WARN_INTERVAL]:
+                del _warned[stale]
+        rate, burst = _LIMITS[kind]
+        bucket = _buckets[key] = TokenBucket(rate, burst)
+    if bucket.delay() > 0:
+        return False
+    bucket.take()
+    return True
+
+async def _reject(update, kind: str, reason: str) -> None:
+    HANDLER_THROTTLED.inc(kind, reason)
+    user_id = update.effective_user.id
+    key = (reason, user_id)
+    now = time.monotonic()
+    if now - _warned.get(key, float('-inf')) < _WARN_INTERVAL:
+        return
+    _warned[key] = now
+    if update.effective_message:
+        await update.effective_message.reply_text(_MESSAGES[reason])
+
+
+def throttled(kind: str):
+    """
+    تحط المعالج خلف دلو الرموز للمستخدم (kind: 'login' أو 'search') والحد العام لمعالجات قاعدة البيانات.
+    عند الرفض المعالج يرجع None، فالـ ConversationHandler يبقى بنفس الحالة.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            global _db_slots
+            user = update.effective_user
+            if user is not None and not _allow(kind, user.id):
+                await _reject(update, kind, kind)
+                return None
+            if _db_slots is None:
+                _db_slots = asyncio.Semaphore(DB_HANDLER_CONCURRENCY)
+            if _db_slots.locked():
+                # رفض فوري بدل ما تتكدس الطلبات بانتظار قاعدة البيانات
+                await _reject(update, kind, 'busy')
+                return None
+            async with _db_slots:
+                return await handler(update, context)
+        return wrapper
+    return decorator
@@ -0,0 +1,232 @@
+# update_processor.py
+"""
+معالج التحديثات (Update Processor) الخاص بالبوت.
+يسمح بمعالجة تحديثات المستخدمين المختلفين بالتوازي، لكن تحديثات نفس المستخدم
+بنفس المحادثة تبقى بالترتيب حتى ما تتلخبط حالة الـ ConversationHandler.
+
+ولما تتراكم التحديثات:
+- ضغطة تنقل (أزرار الصفحات والقوائم، ما تغير بيانات) تنرمى إذا انتظرت دورها بهالعملية أكثر من
+  CALLBACK_MAX_AGE، أو إذا شاشتها أقدم من NAVIGATION_SCREEN_MAX_AGE (يغطي التراكم أثناء إعادة التشغيل)،
+- ضغطة تنقل تنرمى كذلك إذا وراها ضغطة تنقل أحدث على نفس الرسالة،
+- والتحديثات ذات الأولوية الأعلى (مثل بحث المجهزين) تاخذ المكان الفاضي قبل غيرها.
+الضغطات اللي تغير بيانات (ربط محل، حذف...) ما تنرمى أبداً بسبب العمر، وكل ضغطة مرمية ينرد عليها
+(answer) حتى يوقف مؤشر التحميل بالزر.
+بوضع النسخ المتعددة (replicas.py) كل تحديث يمر كذلك بفحص التكرار وإيجار المستخدم بالقاعدة.
+"""
+import os
+import time
+import heapq
+import asyncio
+import logging
+import datetime
+import itertools
+from collections import OrderedDict
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import UPDATES_DROPPED
+
+logger = logging.getLogger(__name__)
+
+# تيليجرام ما يرسل وقت الضغطة، فعمر ضغطة التنقل ينقاس بطريقتين:
+# انتظارها بهالعملية (القفل أو المكان)، وعمر الشاشة اللي انضغطت عليها (edit_date أو date للرسالة).
+# الثاني من تيليجرام نفسه فيبقى صحيح بعد إعادة التشغيل، بس المستخدم ممكن يقرا الشاشة فترة قبل ما يضغط،
+# فحده أطول، والضغطة الثانية على نفس الرسالة بعد التنبيه تمشي.
+CALLBACK_MAX_AGE = float(os.getenv('CALLBACK_MAX_AGE', '15'))
+NAVIGATION_SCREEN_MAX_AGE = float(os.getenv('NAVIGATION_SCREEN_MAX_AGE', '600'))
+_EXPIRED_NOTICE = "⌛ انتهت صلاحية الضغطة، اضغط مرة ثانية."
+# أقصى عدد رسائل نتذكر إننا نبهنا عليها (حتى الضغطة الجاية عليها تمشي)
+_MAX_EXPIRED_NOTICES = 10000
+
+
+class _PriorityGate:
+    """مثل Semaphore، بس المنتظرين يدخلون حسب الأولوية (الرقم الأصغر أولاً) ثم حسب الوصول."""
+
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._active = 0
+        self._waiters = [] # heap من (priority, seq, future)
+        self._counter = itertools.count()
+
+    async def acquire(self, priority: int) -> None:
+        if self._active < self._limit and not self._waiters:
+            self._active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # إذا انعطينا المكان قبل الإلغاء لازم نرجعه
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        # المكان ينتقل مباشرة لأول منتظر (بدون ما ينقص ويزيد العداد)
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    ينفذ التحديثات بالتوازي بين المستخدمين وبالتسلسل لنفس (المحادثة، المستخدم)،
+    بحد أقصى max_concurrent_updates تحديث بنفس الوقت يتوزع حسب priority(update).
+    priority: دالة ترجع رقم الأولوية للتحديث (الأصغر أولاً)، navigation: regex لبيانات أزرار التنقل
+    (ما تغير بيانات) اللي ممكن نتجاهلها إذا قدمت أو إذا وراها ضغطة أحدث على نفس الرسالة.
+    max_pending_updates: أقصى عدد تحديثات مقبولة (تشتغل أو تنتظر دورها).
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int = None,
+                 priority=None, navigation=None, callback_max_age: float = CALLBACK_MAX_AGE,
+                 screen_max_age: float = NAVIGATION_SCREEN_MAX_AGE):
+        super().__init__(max_pending_updates or max_concurrent_updates * 16)
+        self._gate = _PriorityGate(max_concurrent_updates)
+        self._priority = priority
+        self._navigation = navigation
+        self._callback_max_age = callback_max_age
+        self._screen_max_age = screen_max_age
+        # (chat_id, user_id) -> [Lock, عدد التحديثات المنتظرة]
+        self._locks = {}
+        # (chat_id, message_id, user_id) -> update_id لآخر ضغطة تنقل وصلت على هالرسالة
+        self._latest_navigation = {}
+        # (chat_id, message_id, user_id) للرسائل اللي رمينا ضغطتها القديمة ونبهنا المستخدم
+        self._expired_notices = OrderedDict()
+        # ReplicaCoordinator بوضع النسخ المتعددة (يتعين بعد بناء الـ Application)
+        self.coordinator = None
+
+    @staticmethod
+    def update_key(update: object):
+        """نفس المفتاح اللي يستخدمه الـ ConversationHandler (المحادثة + المستخدم)."""
+        if not isinstance(update, Update):
+            return None
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        user_id = update.effective_user.id if update.effective_user else None
+        if chat_id is None and user_id is None:
+            return None
+        return (chat_id, user_id)
+
+    def _navigation_key(self, update):
+        """مفتاح الرسالة إذا التحديث ضغطة تنقل (ممكن ترمى إذا قدمت أو إلغتها ضغطة أحدث)، وإلا None."""
+        query = update.callback_query
+        if (self._navigation is None or query is None or query.message is None
+                or not query.data or not self._navigation.match(query.data)):
+            return None
+        return (query.message.chat.id, query.message.message_id, query.from_user.id)
+
+    def _screen_expired(self, update, navigation_key) -> bool:
+        """ضغطة تنقل على شاشة أقدم من screen_max_age (إلا إذا نبهنا عليها قبل، فالمستخدم ضغط مرة ثانية)."""
+        if self._expired_notices.pop(navigation_key, None) is not None:
+            return False
+        message = update.callback_query.message
+        shown_at = message.edit_date or message.date
+        if shown_at is None:
+            return False
+        return (datetime.datetime.now(datetime.timezone.utc) - shown_at).total_seconds() > self._screen_max_age
+
+    def _drop_reason(self, update, received: float, navigation_key):
+        """
+        سبب رمي ضغطة التنقل أو None: "superseded" إذا وراها ضغطة أحدث على نفس الرسالة،
+        و "stale" إذا انتظرت أكثر من callback_max_age بهالعملية. باقي التحديثات ما تنرمى.
+        """
+        if navigation_key is None:
+            return None
+        if self._latest_navigation.get(navigation_key) != update.update_id:
+            return "superseded"
+        if time.monotonic() - received > self._callback_max_age:
+            return "stale"
+        return None
+
+    async def _drop(self, update, coroutine, reason: str, navigation_key=None) -> None:
+        """ترمي التحديث وترد على الضغطة حتى يوقف مؤشر التحميل (مع تنبيه إذا المستخدم لازم يضغط مرة ثانية)."""
+        UPDATES_DROPPED.inc(reason)
+        coroutine.close()
+        query = update.callback_query if isinstance(update, Update) else None
+        if query is None or reason == "duplicate":
+            # المكرر نسخة ثانية ردت عليه
+            return
+        notice = None
+        if reason == "stale":
+            notice = _EXPIRED_NOTICE
+            if navigation_key is not None:
+                self._expired_notices[navigation_key] = True
+                while len(self._expired_notices) > _MAX_EXPIRED_NOTICES:
+                    self._expired_notices.popitem(last=False)
+        try:
+            await query.answer(notice)
+        except TelegramError as e:
+            logger.debug(f"Could not answer dropped callback query: {e}")
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = self.update_key(update)
+        if key is None:
+            await self._run(update, None, coroutine)
+            return
+
+        received = time.monotonic()
+        navigation_key = self._navigation_key(update)
+        if navigation_key is not None:
+            if self._screen_expired(update, navigation_key):
+                await self._drop(update, coroutine, "stale", navigation_key)
+                return
+            self._latest_navigation[navigation_key] = update.update_id
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                reason = self._drop_reason(update, received, navigation_key)
+                if reason is None:
+                    priority = self._priority(update) if self._priority else 0
+                    await self._run(update, key, coroutine, priority,
+                                    lambda: self._drop_reason(update, received, navigation_key),
+                                    navigation_key)
+                else:
+                    await self._drop(update, coroutine, reason, navigation_key)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+            if navigation_key is not None and self._latest_navigation.get(navigation_key) == update.update_id:
+                del self._latest_navigation[navigation_key]
+
+    async def _run(self, update, key, coroutine, priority: int = 0, drop_reason=None,
+                   navigation_key=None) -> None:
+        """ينفذ التحديث بعد ما ياخذ مكان بالحد العام (وإيجار المستخدم بوضع النسخ المتعددة)."""
+        shared = None
+        if self.coordinator is not None:
+            try:
+                shared = await self.coordinator.begin(update, key)
+            except BaseException:
+                coroutine.close()
+                raise
+            if shared is None:
+                await self._drop(update, coroutine, "duplicate")
+                return
+        try:
+            await self._gate.acquire(priority)
+            try:
+                # نعيد الفحص لأن الانتظار على المكان ممكن طال
+                reason = drop_reason() if drop_reason else None
+                if reason is None:
+                    await coroutine
+                else:
+                    await self._drop(update, coroutine, reason, navigation_key)
+            finally:
+                self._gate.release()
+        finally:
+            if shared is not None:
+                await self.coordinator.end(shared)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass